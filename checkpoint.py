@@ -0,0 +1,114 @@
+import glob
+import json
+import os
+import pickle
+import threading
+import zlib
+from configs import *
+from eventlog import logger
+
+CHECKPOINT_MAGIC = b"STARKCP1"
+
+class Checkpointer:
+    """Periodic background checkpoints of a MedibotSystem plus a write-ahead log of submitted orders.
+
+    The state is pickled in the sim thread at the end of a step (the only consistent point), then
+    compressed and written atomically by a background thread. Every checkpoint starts a new WAL
+    generation; restoring loads the checkpoint and resubmits WAL orders it does not know about.
+    WAL files older than the generation before the last written checkpoint are deleted.
+    """
+    def __init__(self, system, path, interval=CHECKPOINT_INTERVAL):
+        self.system = system
+        self.path = path
+        self.interval = interval
+        self.next_checkpoint = system.clock + interval
+        self.requested = False
+        self.writer = None
+        self.wal_lock = threading.Lock()  # API threads append, the sim thread rotates
+        self.generation = max([self.wal_generation(wal_path) for wal_path in self.wal_paths()], default=0)
+        self.wal = open(self.wal_path(self.generation), "a")
+
+    def wal_path(self, generation):
+        return f"{self.path}.wal.{generation}"
+
+    def wal_paths(self):
+        return glob.glob(f"{glob.escape(self.path)}.wal.*")
+
+    @staticmethod
+    def wal_generation(wal_path):
+        return int(wal_path.rsplit(".", 1)[1])
+
+    def log_orders(self, entries):
+        # entries: [(order_id, order request)], written before the orders are queued
+        lines = "".join(json.dumps({"order_id": order_id, **item}) + "\n" for order_id, item in entries)
+        with self.wal_lock:
+            self.wal.write(lines)
+            self.wal.flush()
+
+    def due(self):
+        return self.requested or self.system.clock >= self.next_checkpoint
+
+    def checkpoint(self):
+        # Caller holds db_lock between steps
+        self.requested = False
+        self.next_checkpoint = self.system.clock + self.interval
+        if self.writer is not None and self.writer.is_alive():
+            # skipping would make the checkpoint ticks depend on disk speed
+            logger.warning("Checkpoint at tick %s waits for the previous checkpoint to be written", self.system.clock)
+            self.writer.join()
+        with self.wal_lock:
+            self.wal.close()
+            self.generation += 1
+            self.wal = open(self.wal_path(self.generation), "a")
+            generation = self.generation
+        # orders logged to the new generation but already drained are skipped on replay, their ids are known
+        data = pickle.dumps({"generation": generation, "state": self.system.checkpoint_state()}, protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer = threading.Thread(target=self.write, args=(data, generation), daemon=True)
+        self.writer.start()
+        return generation
+
+    def write(self, data, generation):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(CHECKPOINT_MAGIC)
+            file.write(zlib.compress(data, 1))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+        for wal_path in self.wal_paths():
+            if self.wal_generation(wal_path) < generation - 1:
+                os.remove(wal_path)
+        logger.info("Checkpoint %s written to %s", generation, self.path)
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+
+    def load(self):
+        with open(self.path, "rb") as file:
+            data = file.read()
+        if not data.startswith(CHECKPOINT_MAGIC):
+            raise Exception(f"{self.path} is not a checkpoint")
+        return pickle.loads(zlib.decompress(data[len(CHECKPOINT_MAGIC):]))
+
+    def wal_entries(self, generation):
+        # orders logged since the generation before the checkpoint, in submission order per file
+        entries = []
+        for wal_path in sorted(self.wal_paths(), key=self.wal_generation):
+            if self.wal_generation(wal_path) < generation - 1:
+                continue
+            with open(wal_path) as file:
+                for line in file:
+                    if line.strip():
+                        entries.append(json.loads(line))
+        return entries
+
+    def restore(self):
+        """Load the last checkpoint into the system and resubmit orders logged after it, returns the resubmitted count."""
+        checkpoint = self.load()
+        system = self.system
+        system.restore_state(checkpoint["state"])
+        self.next_checkpoint = system.clock + self.interval
+        resubmitted = system.replay_orders(self.wal_entries(checkpoint["generation"]))
+        logger.info("Restored checkpoint %s at tick %s, %s orders resubmitted from the WAL", checkpoint["generation"], system.clock, resubmitted)
+        return resubmitted
@@ -1,31 +1,253 @@
 from configs import *
-import time
+from eventlog import logger
+import itertools
+import numpy as np
 class Position:
+    __slots__ = ("x", "y")
+
     def __init__(self, x=0.0, y=0.0):
         self.x, self.y = x, y
 
+class PositionView(Position):
+    # Row of an (N, 2) fleet array, so batched updates are visible to the renderer and API
+    __slots__ = ("array", "index")
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    @property
+    def x(self):
+        return float(self.array[self.index, 0])
+
+    @x.setter
+    def x(self, value):
+        self.array[self.index, 0] = value
+
+    @property
+    def y(self):
+        return float(self.array[self.index, 1])
+
+    @y.setter
+    def y(self, value):
+        self.array[self.index, 1] = value
+
+class SlotTable:
+    # Fixed-size slots of an AMR or Station addressed by index,
+    # only written through MedibotSystem.set_slot_object/reserve_slot/release_reservation
+    __slots__ = ("objects", "reservations", "free", "reserved", "held")
+
+    def __init__(self, capacity):
+        self.objects = [None] * capacity    # object_id held by each slot
+        self.reservations = [()] * capacity # order_ids reserving each slot
+        self.free = list(range(capacity))   # indices of empty slots, ascending
+        self.reserved = {}                  # order_id -> reserved slot index
+        self.held = set()                   # object_ids currently held
+
+    def __len__(self):
+        return len(self.objects)
+
+class QueueCosts:
+    # Cost-model tables of one AMR queue, refreshed from the first stale task by MedibotSystem.queue_tables()
+    __slots__ = ("stale", "stations", "open", "asleep", "loads", "eligible", "legs", "prefix", "keys", "pickup")
+
+    def __init__(self, station_count):
+        self.stale = None                       # first task index whose entries are out of date, None when current
+        self.stations = np.zeros(0, dtype=int)  # station index of each task
+        self.open = np.zeros(0, dtype=bool)     # task can take more suborders
+        self.asleep = np.zeros(0, dtype=int)    # deliveries of sleeping tasks up to each task, their objects stay on the AMR
+        self.loads = np.zeros(0, dtype=int)     # objects on the AMR after each task, expected plus asleep
+        self.eligible = np.zeros(0, dtype=bool) # task can take one more pickup
+        self.legs = np.zeros(0)                 # travel + transfer cost of reaching each task from the previous one
+        self.prefix = np.zeros(1)               # prefix[i]: cost of tasks[1:i] travelling from tasks[0]
+        self.keys = np.zeros(0, dtype=int)      # sorted station * (len + 1) + task index, for next-task lookups
+        self.pickup = np.full(station_count, -1) # first eligible task index at each station, -1 if none
+
+class TaskQueue:
+    # Tasks of one AMR in execution order with the objects expected on the AMR after each task, edits keep both aligned.
+    # Positions count from the head; popleft() and position() are O(1), insert/remove reindex the tasks after them.
+    __slots__ = ("items", "states", "head", "offsets", "dirty")
+
+    def __init__(self):
+        self.items = []     # tasks, the queue is items[head:]
+        self.states = []    # expected objects on the AMR after each task, aligned with items
+        self.head = 0
+        self.offsets = {}   # task id -> index in items
+        self.dirty = None   # first position whose expected state is stale, None if all are current
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    def __iter__(self):
+        return itertools.islice(self.items, self.head, None)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            start, stop, step = position.indices(len(self))
+            if step != 1:
+                raise Exception("TaskQueue slices cannot have a step")
+            return self.items[self.head+start:self.head+max(start, stop)]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("task queue position out of range")
+        return self.items[self.head+position]
+
+    def __contains__(self, task):
+        return self.position(task) is not None
+
+    def position(self, task):
+        # None if the task is not queued
+        index = self.offsets.get(task.id)
+        if index is None:
+            return None
+        return index - self.head
+
+    def state(self, position):
+        return self.states[self.head+position]
+
+    def expected_states(self, start=0):
+        return self.states[self.head+start:]
+
+    def mark_dirty(self, position):
+        if self.dirty is None or position < self.dirty:
+            self.dirty = position
+
+    def reindex(self, index):
+        for i in range(index, len(self.items)):
+            self.offsets[self.items[i].id] = i
+
+    def append(self, task):
+        self.offsets[task.id] = len(self.items)
+        self.items.append(task)
+        self.states.append(set())
+        self.mark_dirty(len(self)-1)
+
+    def insert(self, position, task):
+        index = self.head + position
+        self.items.insert(index, task)
+        self.states.insert(index, set())
+        self.reindex(index)
+        self.mark_dirty(position)
+
+    def remove(self, task):
+        # returns the position the task had
+        position = self.position(task)
+        if position is None:
+            raise Exception(f"Task {task.id} is not queued")
+        index = self.head + position
+        del self.items[index]
+        del self.states[index]
+        del self.offsets[task.id]
+        self.reindex(index)
+        self.mark_dirty(position)
+        return position
+
+    def move_to_front(self, task):
+        self.remove(task)
+        self.insert(0, task)
+
+    def replace(self, start, tasks):
+        # the tasks from position start on become tasks
+        index = self.head + start
+        for task in self.items[index:]:
+            del self.offsets[task.id]
+        self.items[index:] = tasks
+        self.states[index:] = [set() for _ in tasks]
+        self.reindex(index)
+        self.mark_dirty(start)
+
+    def popleft(self):
+        # the remaining states still hold, the AMR now carries exactly the state of the removed task
+        task = self.items[self.head]
+        del self.offsets[task.id]
+        self.items[self.head] = None
+        self.states[self.head] = None
+        self.head += 1
+        if self.dirty is not None:
+            self.dirty = max(0, self.dirty-1)
+        if self.head * 2 >= len(self.items):
+            # drop the removed slots once they are half of the storage, amortized O(1)
+            del self.items[:self.head]
+            del self.states[:self.head]
+            self.head = 0
+            self.reindex(0)
+        return task
+
+    def refresh(self, held):
+        # recompute the expected states from the first dirty position, held: objects on the AMR now
+        if self.dirty is None:
+            return
+        start = min(self.dirty, len(self))
+        state = set(held) if start == 0 else self.states[self.head+start-1]
+        for index in range(self.head+start, len(self.items)):
+            task = self.items[index]
+            pickup_objects = {suborder.object_id for suborder in task.suborders if suborder.type == "pickup"}
+            delivery_objects = {suborder.object_id for suborder in task.suborders if suborder.type == "delivery"}
+            state = state.union(pickup_objects).difference(delivery_objects)
+            self.states[index] = state
+        self.dirty = None
+
 class AMR:
-    def __init__(self, amr_id, x=0.0, y=0.0):
+    __slots__ = ("id", "index", "goal_array", "moving_array", "status", "is_parked", "slots", "task", "task_id",
+                 "position", "_goal", "goal_timestamp", "height", "width", "color")
+
+    def __init__(self, amr_id, x=0.0, y=0.0, capacity=AMR_SLOT_CAPACITY):
         self.id = amr_id
+        # standalone storage until bind() attaches the AMR to the fleet arrays of MedibotSystem
+        self.index = 0
+        self.goal_array = np.array([[x, y]], dtype=float)
+        self.moving_array = np.zeros(1, dtype=bool)
         self.status = "idle"    # idle, busy
         self.is_moving = False
         self.is_parked = False
-        self.slots = {f"slot_{i}": {"object_id": None, "reservation": []} for i in range(AMR_SLOT_CAPACITY)}
+        self.slots = SlotTable(capacity)
         self.task = None
         self.task_id = None
-        self.position = Position(x, y)
+        self.position = PositionView(np.array([[x, y]], dtype=float), 0)
         self.goal = Position(x,y)
         self.goal_timestamp = None
         self.height = AMR_HEIGHT
         self.width = AMR_WIDTH
         self.color = AMR_COLOR
 
+    def bind(self, positions, goals, moving, index):
+        positions[index] = (self.position.x, self.position.y)
+        goals[index] = (self.goal.x, self.goal.y)
+        moving[index] = self.is_moving
+        self.index = index
+        self.position = PositionView(positions, index)
+        self.goal_array = goals
+        self.moving_array = moving
+
+    @property
+    def is_moving(self):
+        return bool(self.moving_array[self.index])
+
+    @is_moving.setter
+    def is_moving(self, value):
+        self.moving_array[self.index] = value
+
+    @property
+    def goal(self):
+        return self._goal
+
+    @goal.setter
+    def goal(self, position:Position):
+        # goal stays the target Position object (identity is used for waiting), coordinates are mirrored into the array
+        self._goal = position
+        self.goal_array[self.index] = (position.x, position.y)
+
 class Station:
-    def __init__(self, station_id, x=0.0, y=0.0):
+    __slots__ = ("id", "status", "busy_since", "slots", "position", "index", "height", "width", "color", "margin")
+
+    def __init__(self, station_id, x=0.0, y=0.0, capacity=STATION_SLOT_CAPACITY):
         self.id = station_id
         self.status = "idle"
-        self.slots = {f"slot_{i}": {"object_id": None, "reservation": []} for i in range(STATION_SLOT_CAPACITY)}
+        self.busy_since = 0 # clock tick the station last became busy
+        self.slots = SlotTable(capacity)
         self.position = Position(x, y)
+        self.index = None   # row in MedibotSystem.distance_matrix
         # self.docking_position = Position()
         self.height = STATION_HEIGHT
         self.width = STATION_WIDTH
@@ -33,16 +255,22 @@ class Station:
         self.margin = STATION_MARGIN
 
 class Parking:
+    __slots__ = ("id", "occupied", "position", "index", "height", "width", "color", "margin")
+
     def __init__(self, id, x=0.0, y=0.0):
         self.id = id
         self.occupied = False
         self.position = Position(x, y)
+        self.index = None   # row in MedibotSystem.distance_matrix
         self.height = PARKING_HEIGHT
         self.width = PARKING_WIDTH
         self.color = PARKING_COLOR
         self.margin = PARKING_MARGIN
 
 class SubOrder:
+    __slots__ = ("suborder_id", "order_id", "type", "station_id", "object_id", "allow_grouping", "priority",
+                 "status", "task_id", "amr_slot", "station_slot", "timestep")
+
     def __init__(self, suborder_id, order_id, sub_type, station_id, object_id, allow_grouping=True, priority=100):
         self.suborder_id = suborder_id
         self.order_id = order_id
@@ -53,11 +281,15 @@ class SubOrder:
         self.priority = priority
         self.status = "pending" # pending, completed, failed
         self.task_id = None
-        self.amr_slot = None
+        self.amr_slot = None     # slot indices, set when the suborder starts executing
         self.station_slot = None
         self.timestep = 0
+
 class Order:
-    def __init__(self, order_id, source_station, destination_station, object_id, allow_grouping=True, priority=100):
+    __slots__ = ("order_id", "object_id", "source_station", "destination_station", "allow_grouping", "priority",
+                 "suborders", "status", "assigned_amr", "created_at")
+
+    def __init__(self, order_id, source_station, destination_station, object_id, allow_grouping=True, priority=100, created_at=0):
         self.order_id = order_id
         self.object_id = object_id
         self.source_station = source_station
@@ -67,13 +299,16 @@ class Order:
         self.suborders = {"pickup": None, "delivery": None}
         self.status = "pending"
         self.assigned_amr = None
+        self.created_at = created_at  # virtual clock tick of creation
 
 class Task:
-    def __init__(self, task_id, assigned_amr, station):
+    __slots__ = ("id", "assigned_amr", "status", "station", "suborders", "time_stamp")
+
+    def __init__(self, task_id, assigned_amr, station, time_stamp=0):
         self.id = task_id
         self.assigned_amr = assigned_amr
-        self.status = "queued"    # queued, executing, completed, failed, sleep
+        self.status = "queued"    # queued, executing, completed, failed, sleep, merged
         self.station = station
         self.suborders = [] # [SubOrder]
-        self.time_stamp = time.time()
-        print(f"Task {self.id} created")
\ No newline at end of file
+        self.time_stamp = time_stamp  # virtual clock tick of creation
+        logger.debug("Task %s created", self.id)
\ No newline at end of file
@@ -1,5 +1,3 @@
-from pygame import Rect
-
 FLEET_SIZE = 1
 TOTAL_STATIONS = 6
 AMR_SLOT_CAPACITY = 4
@@ -9,6 +7,60 @@ DISTANCE_COST = 1
 TRANSFER_COST = 1
 STEP_DISTANCE = 5
 SUBORDER_DURATION = 30
+STATION_WAIT_TIMEOUT = 2000  # ticks an AMR waits for a busy station before failing the pickups it has queued there
+BATCH_ASSIGNMENT = True  # jointly assign orders arriving in the same step, greedy for a single order
+ASSIGNMENT_BUDGET = 16  # pending orders assigned per step, lowest priority value (most urgent) and oldest first, 0 assigns all
+CHEAPEST_INSERTION = True  # insert orders at the cheapest feasible queue positions, False only joins the first matching tasks or appends
+OPTIMIZER_INTERVAL = 200  # ticks between local-search rounds over the AMR queues, 0 disables the optimizer
+OPTIMIZER_THREAD = True  # search in a worker thread, False searches inside step() so seeded runs stay reproducible
+LOG_LEVEL = "INFO"  # level of the "stark" event log, DEBUG includes per-suborder detail
+EVENT_LOG_CAPACITY = 1000  # recent events kept in memory for /medibot/events
+TICK_PERIOD = 0.01  # target wall-clock period of one step in the interactive loop, seconds
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples while the sampling profiler is on
+INTAKE_HISTORY = 10000  # rejected order submissions remembered for /medibot/intake
+STREAM_BUFFER = 1000  # step diffs kept for clients resuming /medibot/stream
+STREAM_KEEPALIVE = 15.0  # seconds between keepalive comments on an idle stream
+SNAPSHOT_WAIT = 1.0  # seconds a read of a stale snapshot waits for the next step to publish a current one
+HISTORY_MEMORY_LIMIT = 10000  # finished orders/suborders/tasks kept in memory per history
+HISTORY_SPILL_BATCH = 1000  # records written to the history store per spill
+HISTORY_DB = "history"  # directory of the per-system SQLite stores for records evicted from memory, None drops them
+CHECKPOINT_INTERVAL = 1000  # ticks between background checkpoints when checkpointing is enabled
+ROADMAP = None  # layout file of the aisle graph AMRs travel on (e.g. "assets/roadmap.json"), None for straight lines
+
+class SystemConfig:
+    """Simulation parameters of one MedibotSystem, defaulting to the constants above.
+
+    seed=None spawns objects with the global random module, any other value gives the system its own Random.
+    """
+    __slots__ = ("fleet_size", "total_stations", "amr_slot_capacity", "station_slot_capacity", "objects",
+                 "distance_cost", "transfer_cost", "step_distance", "suborder_duration", "batch_assignment", "assignment_budget",
+                 "cheapest_insertion", "optimizer_interval", "optimizer_thread", "station_wait_timeout", "roadmap", "seed")
+
+    def __init__(self, **overrides):
+        self.fleet_size = FLEET_SIZE
+        self.total_stations = TOTAL_STATIONS
+        self.amr_slot_capacity = AMR_SLOT_CAPACITY
+        self.station_slot_capacity = STATION_SLOT_CAPACITY
+        self.objects = OBJECTS
+        self.distance_cost = DISTANCE_COST
+        self.transfer_cost = TRANSFER_COST
+        self.step_distance = STEP_DISTANCE
+        self.suborder_duration = SUBORDER_DURATION
+        self.batch_assignment = BATCH_ASSIGNMENT
+        self.assignment_budget = ASSIGNMENT_BUDGET
+        self.cheapest_insertion = CHEAPEST_INSERTION
+        self.optimizer_interval = OPTIMIZER_INTERVAL
+        self.optimizer_thread = OPTIMIZER_THREAD
+        self.station_wait_timeout = STATION_WAIT_TIMEOUT
+        self.roadmap = ROADMAP
+        self.seed = None
+        for name, value in overrides.items():
+            if name not in self.__slots__:
+                raise Exception(f"Unknown config {name}")
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
 
 # Pygame constants
 SCREEN_WIDTH = 500
@@ -20,6 +72,7 @@ SLOT_COLOR_EMPTY = (200, 200, 200)
 SLOT_COLOR_RESERVED = (150, 150, 150)
 SLOT_COLOR_OCCUPIED = (100, 200, 100)
 TEXT_COLOR = (0, 0, 0)
+ROADMAP_COLOR = (215, 215, 215)
 
 LABEL_SIZE = 14
 AMR_WIDTH = 60
@@ -41,5 +94,6 @@ BUTTON_COLOR = (50, 50, 50)
 ICON_COLOR = (0, 0, 0)
 PAUSE_BUTTON_CENTER = (SCREEN_WIDTH - 20, SCREEN_HEIGHT - 20)
 RESET_BUTTON_CENTER = (SCREEN_WIDTH - 60, SCREEN_HEIGHT - 20)
-PAUSE_BUTTON_RECT = Rect(SCREEN_WIDTH - 20 - BUTTON_RADIUS, SCREEN_HEIGHT - 20 - BUTTON_RADIUS, 32, 32)
-RESET_BUTTON_RECT = Rect(SCREEN_WIDTH - 60 - BUTTON_RADIUS, SCREEN_HEIGHT - 20 - BUTTON_RADIUS, 32, 32)
\ No newline at end of file
+# (left, top, width, height), wrapped in pygame.Rect by the renderer so configs stays pygame-free
+PAUSE_BUTTON_RECT = (SCREEN_WIDTH - 20 - BUTTON_RADIUS, SCREEN_HEIGHT - 20 - BUTTON_RADIUS, 32, 32)
+RESET_BUTTON_RECT = (SCREEN_WIDTH - 60 - BUTTON_RADIUS, SCREEN_HEIGHT - 20 - BUTTON_RADIUS, 32, 32)
\ No newline at end of file
@@ -0,0 +1,162 @@
+import heapq
+import math
+import numpy as np
+from configs import *
+from classes import *
+
+class DiscreteEventEngine:
+    """Next-event time advance for MedibotSystem.
+
+    Between events every AMR is either travelling in a straight line, counting
+    down a suborder transfer or idle, so those ticks are applied in bulk and a
+    full step() is only run on the tick where something actually happens
+    (arrival, transfer complete, order arrival, assignment, ...).
+    """
+    def __init__(self, system):
+        self.system = system
+        self.order_events = []  # heap of (time, seq, order kwargs)
+        self.event_counter = 0
+
+    def schedule_order(self, time, object_id, source_station, destination_station, allow_grouping=True, priority=100):
+        self.event_counter += 1
+        heapq.heappush(self.order_events, (time, self.event_counter, {
+            "object_id": object_id,
+            "source_station": source_station,
+            "destination_station": destination_station,
+            "allow_grouping": allow_grouping,
+            "priority": priority,
+        }))
+
+    def has_scheduled_orders(self):
+        return len(self.order_events) != 0
+
+    def fire_order_arrivals(self):
+        results = []
+        while self.order_events and self.order_events[0][0] <= self.system.clock:
+            _, _, order = heapq.heappop(self.order_events)
+            results.append(self.system.add_order(**order))
+        return results
+
+    def is_blocked(self, amr:AMR):
+        # Same waiting rule as MedibotSystem.move_to_goal
+        return self.system.goal_blocker(amr) is not None
+
+    def travel_event(self, amr:AMR, kind):
+        if self.is_blocked(amr):
+            return None # waits until the blocking AMR changes goal, which takes a full step
+        distance = self.system.remaining_distance(amr)
+        # the final move is left to step() so arrival snaps onto the goal exactly as in fixed-tick mode
+        return (math.ceil(distance / self.system.config.step_distance) - 1, kind, amr)
+
+    def amr_event(self, amr:AMR):
+        """Return (quiet ticks, kind, amr), None if the AMR has nothing to do, or 0 ticks if it needs a step."""
+        system = self.system
+        queue = system.amr_queues[amr.id]
+        if len(queue) == 0 and amr.is_parked:
+            return None
+        if amr.status == "busy" and amr.task_id is not None:
+            if not self.system.at_goal(amr):
+                if not amr.is_moving:
+                    return (0, "departure", amr)
+                return self.travel_event(amr, "arrival")
+            if amr.is_moving:
+                return (0, "arrival", amr)
+            for suborder in system.tasks[amr.task_id].suborders:
+                if suborder.status in ["completed", "failed"]:
+                    continue
+                if suborder.status == "executing" and suborder.timestep < system.config.suborder_duration:
+                    return (system.config.suborder_duration - suborder.timestep, "transfer_complete", amr)
+                break
+            return (0, "transfer", amr)
+        if amr.status == "error":
+            return None # inert until cancelled
+        if amr.status == "idle" and len(queue) != 0:
+            if system.amr_task_counts[amr.id]["sleep"] != len(queue):
+                return (0, "step", amr)
+            if system.sleep_checked_at.get(amr.id, -1) <= system.state_changed_at:
+                return (0, "wake", amr) # what the sleeping tasks wait on changed since wake_task last looked
+            # step() would find them still asleep and only head for the parking
+            if amr.is_parked:
+                return None
+        if amr.status == "idle":
+            parking = system.parkings[amr.id]
+            if amr.goal is not parking.position or not amr.is_moving or self.system.at_goal(amr):
+                return (0, "parking", amr)
+            return self.travel_event(amr, "parking_arrival")
+        return (0, "step", amr)
+
+    def needs_bookkeeping(self):
+        # task_manager and the order loop of step() must both be no-ops for a tick to be skipped
+        system = self.system
+        if not system.inbox.empty():
+            return True
+        if system.optimizer is not None and system.optimizer.result is not None:
+            return True
+        if system.pending_orders:
+            return True
+        if system.completed_tasks:
+            return True
+        for order_id in system.changed_orders:
+            order = system.orders[order_id]
+            if order.status == "pending" and system.order_outcome(order) is not None:
+                return True
+        return False
+
+    def next_events(self):
+        events = []
+        for amr in self.system.amrs.values():
+            event = self.amr_event(amr)
+            if event is None:
+                continue
+            events.append((event[0], event[1], amr.id))
+        heapq.heapify(events)
+        return events
+
+    def advance(self, ticks):
+        # Bulk equivalent of `ticks` quiet step() calls
+        system = self.system
+        movers = np.zeros(len(system.amrs), dtype=bool)
+        for amr in system.amrs.values():
+            if amr.is_moving and not self.is_blocked(amr):
+                movers[amr.index] = True
+            elif amr.status == "busy" and amr.task_id is not None:
+                for suborder in system.tasks[amr.task_id].suborders:
+                    if suborder.status in ["completed", "failed"]:
+                        continue
+                    if suborder.status == "executing":
+                        suborder.timestep += ticks
+                    break
+        system.move_fleet(steps=ticks, movers=movers)
+        system.clock += ticks
+
+    def quiet_ticks(self, limit):
+        if self.system.paused or self.needs_bookkeeping():
+            return 0
+        events = self.next_events()
+        ticks = limit
+        if events:
+            ticks = min(ticks, events[0][0])
+        if self.order_events:
+            ticks = min(ticks, self.order_events[0][0] - self.system.clock)
+        optimizer = self.system.optimizer
+        if optimizer is not None and optimizer.worker is None:
+            ticks = min(ticks, optimizer.next_run - self.system.clock)
+        return max(0, ticks)
+
+    def run(self, max_ticks=None, until_drained=True):
+        system = self.system
+        start = system.clock
+        end = None if max_ticks is None else start + max_ticks
+        while end is None or system.clock < end:
+            self.fire_order_arrivals()
+            if until_drained and not system.has_pending_work():
+                break
+            limit = math.inf if end is None else end - system.clock
+            ticks = self.quiet_ticks(limit)
+            if ticks == math.inf:
+                break # nothing will ever happen again
+            if ticks > 0:
+                system.profiler.timed("advance", self.advance, ticks)
+                continue
+            system.step()
+        return system.clock - start
@@ -0,0 +1,41 @@
+import collections
+import logging
+from configs import *
+
+# Leveled event log of the simulation. Call sites pass %-style arguments so disabled levels never format.
+logger = logging.getLogger("stark")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent records in memory, formatted only when read."""
+    def __init__(self, capacity=EVENT_LOG_CAPACITY):
+        super().__init__()
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def events(self, limit=None, level=logging.NOTSET):
+        records = [record for record in self.records if record.levelno >= level]
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return [{"time": record.created, "level": record.levelname, "message": record.getMessage()} for record in records]
+
+recent_events = RingBufferHandler()
+logger.addHandler(recent_events)
+
+def set_level(level):
+    logger.setLevel(level)
+
+def enable_console(level=None):
+    # Console output is opt-in, the simulation itself never writes to stdout
+    for handler in logger.handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setLevel(level or logging.NOTSET)
+            return handler
+    handler = logging.StreamHandler()
+    handler.setLevel(level or logging.NOTSET)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    return handler
@@ -1,12 +1,15 @@
 from flask import Flask, request, jsonify
+import json
+import logging
 from classes import *
+from eventlog import logger, recent_events
 
 def create_flask_app(system):
     app = Flask(__name__)
 
     @app.route("/medibot/add_order", methods=["POST"])
     def add_order():
-        print("received request to add order")
+        logger.debug("received request to add order")
         try:
             data = request.json
                 
@@ -19,106 +22,163 @@ def create_flask_app(system):
                 object_id = [object_id]
             res = []
             if type(object_id) == list and len(object_id) > 0 and all(isinstance(item, str) for item in object_id):
-                for item in object_id:
-                    res.append(system.add_order(item, source_station, destination_station,
-                                            allow_grouping=allow_grouping, priority=priority))
+                res = system.submit_orders([{"object_id": item, "source_station": source_station, "destination_station": destination_station,
+                                          "allow_grouping": allow_grouping, "priority": priority} for item in object_id])
 
             return jsonify(res)
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/add_orders", methods=["POST"])
+    def add_orders():
+        # Bulk ingestion: a JSON array of orders, or NDJSON with one order object per line.
+        # Malformed items and unknown stations fail in the response, the rest are queued for the next step
+        # and their outcome is reported by /medibot/intake/<order_id>
+        try:
+            if request.mimetype in ["application/x-ndjson", "application/ndjson", "application/jsonl"]:
+                items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+            else:
+                items = request.get_json()
+            if not isinstance(items, list):
+                raise Exception("Expected a JSON array or NDJSON stream of orders")
+            res = system.submit_orders(items)
+            accepted = sum(1 for item in res if item["success"])
+            return jsonify({"status": "success", "accepted": accepted, "rejected": len(res) - accepted, "results": res})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
         
+    def snapshot_response(section, key):
+        # Served from the snapshot published by step(), unchanged sections answer 304 to If-None-Match
+        snapshot = system.snapshots.read()
+        if section not in snapshot.sections:
+            raise Exception(f"Unknown {section.split(':')[-1]}")
+        etag = snapshot.etag(section)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            body = snapshot.body(section, lambda payload: app.json.dumps({"status": "success", key: payload} if key else {"status": "success", **payload}))
+            response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["X-Snapshot-Version"] = str(snapshot.version)
+        response.headers["X-Snapshot-Clock"] = str(snapshot.clock)
+        return response
+
     @app.route("/medibot/orders", methods=["GET"])
     def get_orders():
         try:
-            res = {}
-            for order_id, order in system.orders.items():
-                if not isinstance(order, Order):
-                    raise Exception("Unexpected order type.")
-                res[order_id] = {
-                    "id": order.order_id, 
-                    "object_id": order.object_id, 
-                    "source_station": order.source_station.id, 
-                    "destination_station": order.destination_station.id,
-                    "status": order.status, 
-                    "pickup_id": order.suborders["pickup"].suborder_id, 
-                    "delivery_id": order.suborders["pickup"].suborder_id, 
-                    "allow_grouping": order.allow_grouping, 
-                    "priority": order.priority
-                    }
-            return jsonify({"status": "success", "orders": res})
+            return snapshot_response("orders", "orders")
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
         
     @app.route("/medibot/suborders", methods=["GET"])
     def get_suborders():
         try:
-            res = {}
-            for suborder_id, suborder in system.suborders.items():
-                if not isinstance(suborder, SubOrder):
-                    raise Exception("Unexpected suborder type.")
-                res[suborder_id] = {
-                    "id": suborder.suborder_id,
-                    "order_id": suborder.order_id,
-                    "type": suborder.type,
-                    "station_id": suborder.station_id,
-                    "object_id": suborder.object_id,
-                    "status": suborder.status,
-                    "allow_grouping": suborder.allow_grouping,
-                    "priority": suborder.priority
-                }
-            return jsonify({"status": "success", "suborders": res})
+            return snapshot_response("suborders", "suborders")
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
         
     @app.route("/medibot/tasks", methods=["GET"])
     def get_tasks():
         try:
-            res = {}
-            for task_id, task in system.tasks.items():
-                if not isinstance(task, Task):
-                    raise Exception("Unexpected task type.")
-                suborder_description = []
-                for suborder in task.suborders:
-                    suborder_description.append(f"{suborder.suborder_id}: {suborder.type} {suborder.object_id} {'to' if suborder.type == 'delivery' else 'from'} {suborder.station_id}")
-                res[task_id] = {
-                    "id": task.id,
-                    "assigned_amr": task.assigned_amr,
-                    "status": task.status,
-                    "station": task.station.id,
-                    "suborders": [suborder.suborder_id for suborder in task.suborders],
-                    "suborder_description": suborder_description
-                }
-            return jsonify({"status": "success", "tasks": res})
+            return snapshot_response("tasks", "tasks")
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
     @app.route("/medibot/queues", methods=["GET"])
     def get_queue():
         try:
-            tasks = []
-            expected_states = []
             amr_id = request.args.get("amr_id")
-            for state in system.amr_queues[amr_id]["expected_states"]:
-                expected_states.append(list(state))
-            for task in system.amr_queues[amr_id]["tasks"]:
-                if not isinstance(task, Task):
-                    raise Exception("Unexpected task type.")
-                suborder_description = []
-                for suborder in task.suborders:
-                    suborder_description.append(f"{suborder.suborder_id}: {suborder.type} {suborder.object_id} {'to' if suborder.type == 'delivery' else 'from'} {suborder.station_id}")
-                tasks.append({
-                    "id": task.id,
-                    "assigned_amr": task.assigned_amr,
-                    "status": task.status,
-                    "station": task.station.id,
-                    "suborders": [suborder.suborder_id for suborder in task.suborders],
-                    "suborder_description": suborder_description
-                })
-
-            return jsonify({"status": "success", "tasks": tasks, "expected_states": expected_states})
+            return snapshot_response(f"queue:{amr_id}", None)
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/intake/<int:order_id>", methods=["GET"])
+    def get_intake(order_id):
+        try:
+            status = system.intake_status(order_id)
+            if status is None:
+                raise Exception(f"Unknown order {order_id}")
+            return jsonify({"status": "success", **status})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/stream", methods=["GET"])
+    def stream():
+        # Server-sent events of per-step state diffs, resumable through Last-Event-ID or ?since=
+        since = request.headers.get("Last-Event-ID", request.args.get("since"))
+        since = int(since) if since not in [None, ""] else None
+
+        def events():
+            for event_id, event_type, data in system.stream.follow(since):
+                if event_id is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+        return app.response_class(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.route("/medibot/history/<kind>", methods=["GET"])
+    def get_history(kind):
+        # Finished orders, suborders or tasks in id order, page with ?after=<next> until next is null
+        try:
+            histories = {"orders": system.orders_history, "suborders": system.suborders_history, "tasks": system.tasks_history}
+            if kind not in histories:
+                raise Exception(f"Unknown history {kind}, expected one of {list(histories)}")
+            limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+            records = histories[kind].query(after=request.args.get("after", 0, type=int), limit=limit,
+                                            status=request.args.get("status"), amr=request.args.get("amr"),
+                                            object_id=request.args.get("object_id"))
+            res = [{**view, "archived_at": clock} for _, clock, view in records]
+            next_after = records[-1][0] if len(records) == limit else None
+            return jsonify({"status": "success", kind: res, "next": next_after, "total": len(histories[kind])})
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
+    @app.route("/medibot/events", methods=["GET"])
+    def get_events():
+        try:
+            limit = request.args.get("limit", type=int)
+            level = logging.getLevelName(request.args.get("level", "NOTSET").upper())
+            if not isinstance(level, int):
+                raise Exception(f"Invalid log level {request.args.get('level')}")
+            events = recent_events.events(limit=limit, level=level)
+            return jsonify({"status": "success", "events": events})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/profile", methods=["GET"])
+    def get_profile():
+        try:
+            top = request.args.get("top", 20, type=int)
+            return jsonify({"status": "success", "profile": system.profiler.snapshot(top=top)})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/profile", methods=["POST"])
+    def set_profile():
+        try:
+            data = request.json or {}
+            if data.get("reset", False):
+                system.profiler.reset()
+            if "sampling" in data:
+                if data["sampling"]:
+                    system.profiler.start_sampling(interval=data.get("interval"))
+                else:
+                    system.profiler.stop_sampling()
+            return jsonify({"status": "success", "sampling": system.profiler.sampler is not None})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
+
+    @app.route("/medibot/checkpoint", methods=["POST"])
+    def request_checkpoint():
+        # Taken at the end of the next step and written in the background
+        try:
+            if system.checkpointer is None:
+                raise Exception("Checkpoints are not enabled, start with --checkpoint PATH")
+            system.checkpointer.requested = True
+            return jsonify({"status": "success", "path": system.checkpointer.path})
+        except Exception as e:
+            return jsonify({"status": "error", "message": str(e)})
 
     @app.route("/medibot/reset", methods=["POST"])
     def reset():
@@ -133,6 +193,6 @@ def create_flask_app(system):
     
 
 def run_flask(app):
+    logger.info("Flask is running in a background thread.")
     app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)  # use_reloader=False prevents double-threading issues
-    print("Flask is running in a background thread.")
     
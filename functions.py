@@ -1,14 +1,68 @@
 from classes import Position, Task
+import math
 import numpy as np
 
 def _distance(pos1:Position, pos2:Position):
-    return np.linalg.norm(np.array([pos1.x, pos1.y]) - np.array([pos2.x, pos2.y]))
+    return math.hypot(pos1.x - pos2.x, pos1.y - pos2.y)
 
 def arrage_positions(count, entity_size, axis_max, spacing=50):
     total_height = count * entity_size + (count - 1) * spacing if count > 0 else 0
     start = (axis_max - total_height + entity_size) // 2
     return [start + i * (entity_size + spacing) for i in range(count)]
 
+def linear_sum_assignment(cost):
+    """Minimum-cost assignment of rows to columns (Hungarian method, shortest augmenting paths).
+
+    Works on rectangular matrices; every row (or column, if there are fewer) is assigned once.
+    Returns (row_indices, column_indices) sorted by row, like scipy.optimize.linear_sum_assignment.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # 1-based potentials/matching, index 0 is the virtual source column
+    a = np.zeros((n + 1, m + 1))
+    a[1:, 1:] = cost
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    match = np.zeros(m + 1, dtype=int) # row matched to each column, 0 for none
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        match[0] = i
+        j0 = 0
+        min_reduced = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = match[j0]
+            free = ~used
+            reduced = a[i0] - u[i0] - v
+            better = free & (reduced < min_reduced)
+            min_reduced[better] = reduced[better]
+            way[better] = j0
+            candidates = np.where(free, min_reduced, np.inf)
+            j1 = int(np.argmin(candidates))
+            delta = candidates[j1]
+            u[match[used]] += delta
+            v[used] -= delta
+            min_reduced[free] -= delta
+            j0 = j1
+            if match[j0] == 0:
+                break
+        while j0 != 0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+    columns = np.nonzero(match[1:])[0]
+    rows = match[1:][columns] - 1
+    if transposed:
+        rows, columns = columns, rows
+    order = np.argsort(rows)
+    return rows[order], columns[order]
+
 def promote_element(element, lst):
     try:
         lst.remove(element)
@@ -0,0 +1,156 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import types
+from configs import *
+
+class HistoryStore:
+    """Append-only SQLite store for history records evicted from memory.
+
+    The connection is opened on the first write, so runs that never evict do not touch the disk.
+    Rows are keyed by (run_id, kind, id), ids restart after MedibotSystem.reset() but run_id does not.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()  # the sim thread writes, API threads read
+
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS history (
+                run_id TEXT, kind TEXT, id INTEGER, status TEXT, amr TEXT, object_id TEXT, clock INTEGER, record TEXT,
+                PRIMARY KEY (run_id, kind, id))""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS history_status ON history (run_id, kind, status, id)")
+        return self.connection
+
+    def append(self, rows):
+        with self.lock:
+            connection = self.connect()
+            connection.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.commit()
+
+    def get(self, run_id, kind, record_id):
+        if self.connection is None:
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT record FROM history WHERE run_id = ? AND kind = ? AND id = ?",
+                                          (run_id, kind, record_id)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def query(self, run_id, kind, after=0, limit=100, status=None, amr=None, object_id=None):
+        if self.connection is None:
+            return []
+        sql = "SELECT id, clock, record FROM history WHERE run_id = ? AND kind = ? AND id > ?"
+        args = [run_id, kind, after]
+        for column, value in [("status", status), ("amr", amr), ("object_id", object_id)]:
+            if value is not None:
+                sql += f" AND {column} = ?"
+                args.append(value)
+        sql += " ORDER BY id LIMIT ?"
+        args.append(limit)
+        with self.lock:
+            rows = self.connection.execute(sql, args).fetchall()
+        return [(record_id, clock, json.loads(record)) for record_id, clock, record in rows]
+
+class History:
+    """Bounded, insertion-ordered mapping of finished orders, suborders or tasks.
+
+    Only the newest HISTORY_MEMORY_LIMIT records are kept as live objects; older ones are spilled to the
+    HistoryStore in batches of HISTORY_SPILL_BATCH and come back from get()/[] as read-only namespaces
+    with the fields of their API view.
+    """
+    def __init__(self, kind, view, store, run_id, clock, limit=HISTORY_MEMORY_LIMIT):
+        self.kind = kind
+        self.view = view      # record -> JSON-able dict, the same shape the API serves
+        self.store = store
+        self.run_id = run_id
+        self.clock = clock    # callable returning the current tick, stored with spilled rows
+        self.limit = limit
+        self.records = collections.OrderedDict()  # id -> (clock, record)
+        self.spilled = 0
+
+    def __getstate__(self):
+        # the store and clock belong to the running system, MedibotSystem.restore_state() reattaches them
+        state = self.__dict__.copy()
+        state["store"] = None
+        state["clock"] = None
+        return state
+
+    def __setitem__(self, record_id, record):
+        self.records[record_id] = (self.clock(), record)
+        self.records.move_to_end(record_id)
+        if len(self.records) > self.limit + HISTORY_SPILL_BATCH:
+            self.spill(len(self.records) - self.limit)
+
+    def spill(self, count):
+        rows = []
+        for _ in range(count):
+            record_id, (clock, record) = self.records.popitem(last=False)
+            view = self.view(record)
+            amr = view.get("assigned_amr")
+            rows.append((self.run_id, self.kind, record_id, view.get("status"), amr, view.get("object_id"), clock, json.dumps(view)))
+        if self.store is not None:
+            self.store.append(rows)
+            self.spilled += len(rows)
+
+    def get(self, record_id, default=None):
+        entry = self.records.get(record_id)
+        if entry is not None:
+            return entry[1]
+        if self.store is None:
+            return default
+        view = self.store.get(self.run_id, self.kind, record_id)
+        return default if view is None else types.SimpleNamespace(**view)
+
+    def __getitem__(self, record_id):
+        record = self.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def __contains__(self, record_id):
+        # in-memory records only, so membership tests never query the store; get() also finds spilled ones
+        return record_id in self.records
+
+    def __len__(self):
+        return len(self.records) + self.spilled
+
+    # iteration only covers the records still in memory, use query() to page through everything
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def keys(self):
+        return list(self.records)
+
+    def values(self):
+        return [record for _, record in list(self.records.values())]
+
+    def items(self):
+        return [(record_id, record) for record_id, (_, record) in list(self.records.items())]
+
+    def query(self, after=0, limit=100, status=None, amr=None, object_id=None):
+        """Records with id > after in id order, filtered on the API view fields; keyset pagination by id."""
+        results = self.store.query(self.run_id, self.kind, after, limit, status, amr, object_id) if self.store is not None else []
+        for record_id, (clock, record) in list(self.records.items()):
+            if record_id <= after:
+                continue
+            view = self.view(record)
+            if status is not None and view.get("status") != status:
+                continue
+            if amr is not None and view.get("assigned_amr") != amr:
+                continue
+            if object_id is not None and view.get("object_id") != object_id:
+                continue
+            results.append((record_id, clock, view))
+        results.sort(key=lambda result: result[0])
+        return results[:limit]
+
+def new_run_id():
+    return f"{time.time_ns()}"
@@ -0,0 +1,383 @@
+import threading
+from configs import *
+from classes import *
+from eventlog import logger
+
+MAX_MOVES = 500  # improving moves per search, bounds a round on long queues
+EPSILON = 1e-9
+
+class QueueOptimizer:
+    """Periodic local search over the queued tails of the AMR queues, minimizing fleet travel.
+
+    Every interval ticks step() copies the tail of each queue that has not started (after the last task
+    that is executing, sleeping or partly done) as plain data. A worker thread improves it with task
+    relocation, 2-opt and same-station merges within a queue, and moves whole orders between AMRs when
+    that shortens the fleet's travel without delaying the later of the two queues. Capacity is checked
+    as the executor applies it: the load after every task keeps the spare slot free, and objects of
+    sleeping deliveries ahead of the tail stay on board (queue_tables() loads). A later step() swaps
+    the result in, but only for a plan whose queue tails are all unchanged since the copy, so step()
+    never waits on the search.
+    With background=False the search runs inside step() instead, which keeps seeded runs reproducible.
+    """
+    def __init__(self, system, interval=OPTIMIZER_INTERVAL, background=OPTIMIZER_THREAD):
+        self.system = system
+        self.interval = interval
+        self.background = background
+        self.next_run = system.clock + interval
+        self.worker = None
+        self.result = None  # set by the worker, taken by the sim thread
+        self.applied = 0
+        self.discarded = 0
+
+    def due(self):
+        return self.result is not None or (self.worker is None and self.system.clock >= self.next_run)
+
+    def tick(self):
+        # Caller holds db_lock between steps
+        if self.result is not None:
+            result, self.result, self.worker = self.result, None, None
+            self.apply(result)
+        if self.worker is None and self.system.clock >= self.next_run:
+            self.next_run = self.system.clock + self.interval
+            plan = self.capture()
+            if self.background:
+                self.worker = threading.Thread(target=self.search, args=(plan,), daemon=True)
+                self.worker.start()
+            else:
+                self.apply(improve_queues(plan))
+
+    def search(self, plan):
+        try:
+            result = improve_queues(plan)
+        except Exception:
+            logger.exception("Queue optimizer failed")
+            result = {"queues": {}, "fingerprints": {}, "saved": 0.0}
+        self.result = result
+
+    @staticmethod
+    def tail_start(tasks):
+        # first task of the trailing run that has not started, only those are moved
+        start = len(tasks)
+        while start > 0 and tasks[start-1].status == "queued" and all(suborder.status == "pending" for suborder in tasks[start-1].suborders):
+            start -= 1
+        return start
+
+    def tail_base(self, amr_id, start):
+        # objects on the AMR when the tail starts, those of sleeping deliveries ahead of it included
+        if not start:
+            return len(self.system.amrs[amr_id].slots.held)
+        return int(self.system.queue_tables(amr_id).loads[start-1])
+
+    def fingerprint(self, amr_id):
+        tasks = self.system.amr_queues[amr_id]
+        start = self.tail_start(tasks)
+        return start, tuple((task.id, tuple(suborder.suborder_id for suborder in task.suborders)) for task in tasks[start:])
+
+    def capture(self):
+        system = self.system
+        config = system.config
+        station_count = len(system.stations)
+        distances = system.distance_matrix[:station_count, :station_count]
+        amr_distances = system.amr_node_distances()
+        queues = []
+        for amr_id, amr in system.amrs.items():
+            system.update_expected_states(amr)
+            tasks = system.amr_queues[amr_id]
+            start, fingerprint = self.fingerprint(amr_id)
+            # cost of reaching the end of the running part of the queue
+            lead = 0.0
+            travel = 0.0
+            for task_index, task in enumerate(tasks[:start]):
+                travel += amr_distances[amr.index, task.station.index] if task_index == 0 else distances[tasks[task_index-1].station.index, task.station.index]
+                lead += len(task.suborders) * config.transfer_cost
+            lead += travel * config.distance_cost
+            origin = distances[tasks[start-1].station.index] if start else amr_distances[amr.index, :station_count]
+            base = self.tail_base(amr_id, start)
+            # the executor only picks up while a slot stays free besides the spare one, as queue_tables() loads
+            limit = config.amr_slot_capacity - 1
+            loads = system.queue_tables(amr_id).loads[start:]
+            queues.append({
+                "amr_id": amr_id,
+                "fingerprint": (base, fingerprint),
+                "origin": origin.tolist(),
+                "lead": lead,
+                "base": base,
+                "limit": limit,
+                # a tail that already needs the spare slot is left to the executor
+                "frozen": max([base] + loads.tolist()) > limit,
+                "visits": [(task.station.index, tuple((suborder.suborder_id, suborder.type == "pickup", suborder.order_id) for suborder in task.suborders), task.id)
+                           for task in tasks[start:]],
+            })
+        return {"queues": queues, "distances": distances.tolist(), "distance_cost": config.distance_cost,
+                "transfer_cost": config.transfer_cost, "suborder_limit": config.amr_slot_capacity + config.station_slot_capacity - 2}
+
+    def apply(self, result):
+        system = self.system
+        if not result["queues"]:
+            return False
+        for amr_id, fingerprint in result["fingerprints"].items():
+            start, tail = self.fingerprint(amr_id)
+            if (self.tail_base(amr_id, start), tail) != fingerprint:
+                self.discarded += 1
+                logger.debug("Queue optimizer result discarded, queue of %s changed during the search", amr_id)
+                return False
+        stations = {station.index: station for station in system.stations.values()}
+        retired = {}
+        for amr_id in result["queues"]:
+            tasks = system.amr_queues[amr_id]
+            for task in tasks[self.tail_start(tasks):]:
+                retired[task.id] = task
+        for amr_id, visits in result["queues"].items():
+            tasks = system.amr_queues[amr_id]
+            start = self.tail_start(tasks)
+            tail = []
+            for station_index, suborders, task_id in visits:
+                task = retired.pop(task_id, None)
+                if task is None:
+                    system.task_counter += 1
+                    task = Task(task_id=system.task_counter, assigned_amr=amr_id, station=stations[station_index], time_stamp=system.clock)
+                    system.add_task(task)
+                task.assigned_amr = amr_id  # reused tasks stay in their queue today, but the plan decides
+                task.suborders = [system.suborders[suborder_id] for suborder_id, _, _ in suborders]
+                for suborder in task.suborders:
+                    suborder.task_id = task.id
+                    system.orders[suborder.order_id].assigned_amr = amr_id
+                tail.append(task)
+            tasks.replace(start, tail)
+            system.mark_expected_states_dirty(amr_id, start)
+            system.update_expected_states(system.amrs[amr_id])
+        for task in retired.values():
+            # merged into another task of the queue
+            task.suborders = []
+            system.set_task_status(task, "merged")
+            system.retire_task(task)
+        self.applied += 1
+        logger.info("Queue optimizer rewrote %s queues, %.1f less travel", len(result["queues"]), result["saved"])
+        return True
+
+def route_length(origin, distances, visits):
+    if not visits:
+        return 0.0
+    length = origin[visits[0][0]]
+    for previous, visit in zip(visits, visits[1:]):
+        length += distances[previous[0]][visit[0]]
+    return length
+
+def feasible(visits, base, limit, suborder_limit):
+    # every delivery after its pickup, and the AMR load after each task within limit
+    pickups = {order_id for visit in visits for _, pickup, order_id in visit[1] if pickup}
+    carried = set()
+    load = base
+    for visit in visits:
+        if len(visit[1]) > suborder_limit:
+            return False
+        for _, pickup, order_id in visit[1]:
+            if pickup:
+                carried.add(order_id)
+                load += 1
+                continue
+            if order_id in pickups and order_id not in carried:
+                return False
+            load -= 1
+        if load > limit:
+            return False
+    return True
+
+def queue_moves(queue, plan):
+    """Visits after every improving task relocation, 2-opt and same-station merge within the queue.
+
+    Travel changes are computed from the legs a move replaces (distances are symmetric), the visits are
+    only built for moves that shorten the route and keep every pickup before its delivery."""
+    visits = queue["visits"]
+    distances = plan["distances"]
+    origin = queue["origin"]
+    count = len(visits)
+    pickup_at = {order_id: k for k, visit in enumerate(visits) for _, pickup, order_id in visit[1] if pickup}
+    delivery_at = {order_id: k for k, visit in enumerate(visits) for _, pickup, order_id in visit[1] if not pickup}
+    # task k has to stay after earliest[k] and before latest[k], a run i..j-1 can only be reversed if no order lies inside it
+    earliest = [-1] * count
+    latest = [count] * count
+    closes = [count] * (count + 1)
+    for order_id, k in delivery_at.items():
+        if order_id in pickup_at:
+            earliest[k] = max(earliest[k], pickup_at[order_id])
+            latest[pickup_at[order_id]] = min(latest[pickup_at[order_id]], k)
+    for k in range(count - 1, -1, -1):
+        closes[k] = min(closes[k + 1], latest[k])
+    def at(position):
+        # station of a queue position, None before the first task (the origin) and after the last one
+        return visits[position][0] if 0 <= position < count else None
+    def leg(a, b):
+        if b is None:
+            return 0.0
+        return origin[b] if a is None else distances[a][b]
+    for i in range(count):
+        station = visits[i][0]
+        removal = leg(at(i - 1), at(i + 1)) - leg(at(i - 1), station) - leg(station, at(i + 1))
+        # relocate task i to position j of the queue without it
+        for j in range(count):
+            if j == i:
+                continue
+            before, after = (j - 1 if j - 1 < i else j), (j if j < i else j + 1)
+            if before < earliest[i] or after > latest[i]:
+                continue
+            if removal + leg(at(before), station) + leg(station, at(after)) - leg(at(before), at(after)) < -EPSILON:
+                rest = visits[:i] + visits[i+1:]
+                yield rest[:j] + [visits[i]] + rest[j:]
+        # merge task i into another task at the same station
+        if removal < -EPSILON:
+            for j in range(count):
+                if j != i and visits[j][0] == station and earliest[i] < j < latest[i]:
+                    merged = (station, visits[j][1] + visits[i][1], visits[j][2])
+                    yield [merged if k == j else visit for k, visit in enumerate(visits) if k != i]
+    # 2-opt: reverse the run of tasks i..j-1
+    for i in range(count - 1):
+        for j in range(i + 2, min(closes[i], count) + 1):
+            if leg(at(i - 1), at(j - 1)) + leg(at(i), at(j)) - leg(at(i - 1), at(i)) - leg(at(j - 1), at(j)) < -EPSILON:
+                yield visits[:i] + visits[i:j][::-1] + visits[j:]
+
+def improve_queue(queue, plan):
+    if queue["frozen"]:
+        return False
+    length = route_length(queue["origin"], plan["distances"], queue["visits"])
+    for visits in queue_moves(queue, plan):
+        if route_length(queue["origin"], plan["distances"], visits) < length - EPSILON and \
+                feasible(visits, queue["base"], queue["limit"], plan["suborder_limit"]):
+            queue["visits"] = visits
+            return True
+    return False
+
+def finish_cost(queue, visits, plan):
+    suborders = sum(len(visit[1]) for visit in visits)
+    return queue["lead"] + route_length(queue["origin"], plan["distances"], visits) * plan["distance_cost"] + suborders * plan["transfer_cost"]
+
+def insertions(queue, visits, plan, pickup, source, delivery, destination, bound):
+    """(extra travel, visits) of every feasible placement of an order into feasible visits of the queue
+    cheaper than bound, cheapest first.
+
+    Positions are as in MedibotSystem.insertion_cost_matrix(): joining the task at the station, or a new
+    task in any gap (gap g is before task g). Gaps do not share legs, so the two extra travels add up, and
+    only the loads between pickup and delivery grow, so feasibility is a count of full tasks in between."""
+    distances = plan["distances"]
+    origin = queue["origin"]
+    limit = queue["limit"]
+    suborder_limit = plan["suborder_limit"]
+    count = len(visits)
+    loads = []
+    load = queue["base"]
+    for visit in visits:
+        load += sum(1 if pickup_suborder else -1 for _, pickup_suborder, _ in visit[1])
+        loads.append(load)
+    full = [0]
+    for load in loads:
+        full.append(full[-1] + (load >= limit))
+    def leg(before, station):
+        return origin[station] if before < 0 else distances[visits[before][0]][station]
+    def gap_cost(gap, station):
+        cost = leg(gap - 1, station)
+        if gap < count:
+            cost += distances[station][visits[gap][0]] - leg(gap - 1, visits[gap][0])
+        return cost
+    # (rank, extra travel): rank 2*g is a new task before task g, 2*k+1 joins task k
+    pickup_ranks = [(2 * gap, gap_cost(gap, source)) for gap in range(count + 1) if (loads[gap-1] if gap else queue["base"]) < limit] + \
+                   [(2 * k + 1, 0.0) for k in range(count) if visits[k][0] == source and len(visits[k][1]) < suborder_limit]
+    delivery_ranks = [(2 * gap, gap_cost(gap, destination)) for gap in range(count + 1)] + \
+                     [(2 * k + 1, 0.0) for k in range(count) if visits[k][0] == destination and len(visits[k][1]) < suborder_limit]
+    candidates = []
+    for pickup_rank, pickup_cost in pickup_ranks:
+        for delivery_rank, delivery_cost in delivery_ranks:
+            if delivery_rank < pickup_rank or (delivery_rank == pickup_rank and pickup_rank % 2):
+                continue
+            # the object is carried after the pickup task up to the task before the delivery
+            if full[delivery_rank // 2] != full[pickup_rank // 2]:
+                continue
+            if delivery_rank == pickup_rank:
+                gap = pickup_rank // 2
+                cost = leg(gap - 1, source) + distances[source][destination]
+                if gap < count:
+                    cost += distances[destination][visits[gap][0]] - leg(gap - 1, visits[gap][0])
+            else:
+                cost = pickup_cost + delivery_cost
+            if cost < bound:
+                candidates.append((cost, pickup_rank, delivery_rank))
+    candidates.sort()
+    for cost, pickup_rank, delivery_rank in candidates:
+        placed = list(visits)
+        # the later position first, so the pickup rank still points at the same place
+        for rank, suborder, station in [(delivery_rank, delivery, destination), (pickup_rank, pickup, source)]:
+            if rank % 2:
+                joined = placed[rank // 2]
+                placed[rank // 2] = (joined[0], joined[1] + (suborder,), joined[2])
+            else:
+                placed.insert(rank // 2, (station, (suborder,), None))
+        yield cost, placed
+
+def relocate_order(queues, plan):
+    # move the first order whose relocation within its queue, or to another AMR without delaying the later
+    # of the two queues, shortens fleet travel
+    queues = [queue for queue in queues if not queue["frozen"]]
+    for queue in queues:
+        pickups = {suborder[2]: (visit[0], suborder) for visit in queue["visits"] for suborder in visit[1] if suborder[1]}
+        deliveries = {suborder[2]: (visit[0], suborder) for visit in queue["visits"] for suborder in visit[1] if not suborder[1]}
+        length = route_length(queue["origin"], plan["distances"], queue["visits"])
+        finish = finish_cost(queue, queue["visits"], plan)
+        for order_id in pickups:
+            if order_id not in deliveries:
+                continue
+            (source, pickup), (destination, delivery) = pickups[order_id], deliveries[order_id]
+            remaining = [(visit[0], tuple(suborder for suborder in visit[1] if suborder[2] != order_id), visit[2]) for visit in queue["visits"]]
+            remaining = [visit for visit in remaining if visit[1]]
+            saved = length - route_length(queue["origin"], plan["distances"], remaining)
+            if saved <= EPSILON:
+                continue
+            remaining_finish = finish_cost(queue, remaining, plan)
+            for other in queues:
+                other_finish = finish_cost(other, other["visits"], plan)
+                target = remaining if other is queue else other["visits"]
+                for cost, placed in insertions(other, target, plan, pickup, source, delivery, destination, saved - EPSILON):
+                    if other is queue:
+                        queue["visits"] = placed
+                        return True
+                    if max(remaining_finish, finish_cost(other, placed, plan)) > max(finish, other_finish) + EPSILON:
+                        break
+                    queue["visits"], other["visits"] = remaining, placed
+                    return True
+    return False
+
+def fuse(visits, suborder_limit):
+    # consecutive tasks at the same station become one task, as queue_grouper would
+    fused = []
+    for visit in visits:
+        if fused and fused[-1][0] == visit[0] and len(fused[-1][1]) + len(visit[1]) <= suborder_limit:
+            previous = fused[-1]
+            fused[-1] = (previous[0], previous[1] + visit[1], previous[2] if previous[2] is not None else visit[2])
+            continue
+        fused.append(visit)
+    return fused
+
+def improve_queues(plan):
+    """Local search over a QueueOptimizer.capture() plan, returns the rewritten queue tails and their fingerprints."""
+    queues = plan["queues"]
+    original = {queue["amr_id"]: queue["visits"] for queue in queues}
+    before = sum(route_length(queue["origin"], plan["distances"], queue["visits"]) for queue in queues)
+    moves = 0
+    improved = True
+    while improved and moves < MAX_MOVES:
+        improved = False
+        for queue in queues:
+            while moves < MAX_MOVES and improve_queue(queue, plan):
+                moves += 1
+                improved = True
+        if moves < MAX_MOVES and relocate_order(queues, plan):
+            moves += 1
+            improved = True
+    result = {"queues": {}, "fingerprints": {}, "saved": 0.0}
+    if moves == 0:
+        return result
+    for queue in queues:
+        queue["visits"] = fuse(queue["visits"], plan["suborder_limit"])
+        if queue["visits"] != original[queue["amr_id"]]:
+            result["queues"][queue["amr_id"]] = queue["visits"]
+            result["fingerprints"][queue["amr_id"]] = queue["fingerprint"]
+    result["saved"] = before - sum(route_length(queue["origin"], plan["distances"], queue["visits"]) for queue in queues)
+    return result
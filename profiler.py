@@ -0,0 +1,136 @@
+import bisect
+import collections
+import os
+import sys
+import threading
+from time import perf_counter
+from configs import *
+
+# upper bounds of the timing histogram buckets in seconds, the last bucket is open ended
+HISTOGRAM_BOUNDS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1)
+
+def bucket_label(index):
+    if index == len(HISTOGRAM_BOUNDS):
+        return f">{HISTOGRAM_BOUNDS[-1] * 1e6:g}us"
+    return f"<={HISTOGRAM_BOUNDS[index] * 1e6:g}us"
+
+class PhaseStats:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, elapsed)] += 1
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "histogram": [[bucket_label(i), n] for i, n in enumerate(self.buckets) if n],  # ascending buckets
+        }
+
+class StepProfiler:
+    """Per-phase timing histograms and tick overruns of MedibotSystem.step(), plus an optional stack sampler.
+
+    Recording is a perf_counter pair and a bisect per phase call, so it stays on all the time;
+    the sampling profiler only runs between start_sampling() and stop_sampling().
+    """
+    def __init__(self, target_period=TICK_PERIOD):
+        self.target_period = target_period
+        self.reset()
+        self.sampler = None
+        self.sampler_stop = threading.Event()
+        self.sampling_interval = PROFILE_SAMPLE_INTERVAL
+        self.step_thread = None
+
+    def reset(self):
+        self.phases = {}
+        self.ticks = 0
+        self.overruns = 0
+        self.worst_tick = 0.0
+        self.samples = 0
+        self.self_samples = collections.Counter()      # innermost frame of each sample
+        self.inclusive_samples = collections.Counter() # every function on the sampled stack
+
+    def record(self, phase, elapsed):
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = PhaseStats()
+        stats.add(elapsed)
+
+    def timed(self, phase, function, *args):
+        start = perf_counter()
+        result = function(*args)
+        self.record(phase, perf_counter() - start)
+        return result
+
+    def tick(self, elapsed):
+        self.ticks += 1
+        self.step_thread = threading.get_ident()
+        if elapsed > self.worst_tick:
+            self.worst_tick = elapsed
+        if elapsed > self.target_period:
+            self.overruns += 1
+        self.record("step", elapsed)
+
+    def start_sampling(self, interval=None):
+        if self.sampler is not None:
+            return
+        self.sampling_interval = interval or self.sampling_interval
+        self.sampler_stop.clear()
+        self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        if self.sampler is None:
+            return
+        self.sampler_stop.set()
+        self.sampler.join()
+        self.sampler = None
+
+    @staticmethod
+    def frame_key(frame):
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+    def sample_loop(self):
+        while not self.sampler_stop.wait(self.sampling_interval):
+            frame = sys._current_frames().get(self.step_thread)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_samples[self.frame_key(frame)] += 1
+            seen = set()
+            while frame is not None:
+                key = self.frame_key(frame)
+                if key not in seen:
+                    seen.add(key)
+                    self.inclusive_samples[key] += 1
+                frame = frame.f_back
+
+    def snapshot(self, top=20):
+        return {
+            "ticks": self.ticks,
+            "target_period": self.target_period,
+            "overruns": self.overruns,
+            "worst_tick": self.worst_tick,
+            "phases": {phase: stats.summary() for phase, stats in list(self.phases.items())},
+            "sampling": {
+                "enabled": self.sampler is not None,
+                "interval": self.sampling_interval,
+                "samples": self.samples,
+                # dict() copies atomically while the sampler thread keeps counting
+                "self": collections.Counter(dict(self.self_samples)).most_common(top),
+                "inclusive": collections.Counter(dict(self.inclusive_samples)).most_common(top),
+            },
+        }
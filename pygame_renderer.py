@@ -19,6 +19,7 @@ class Renderer:
         self.mouse_pos = Position()
         self.pause_pos = Position(PAUSE_BUTTON_CENTER[0], PAUSE_BUTTON_CENTER[1])
         self.reset_pos = Position(RESET_BUTTON_CENTER[0], RESET_BUTTON_CENTER[1])
+        self.reset_rect = pygame.Rect(RESET_BUTTON_RECT)
         
     def draw_entity(self, entity, color, label):
         if not isinstance(entity, Station) and not isinstance(entity, AMR) and not isinstance(entity, Parking):
@@ -39,8 +40,7 @@ class Renderer:
         # Draw slots above the rectangle
         slot_x_start = x + (entity.width - (SLOT_SIZE * 4 + SLOT_MARGIN * 3)) // 2
         slot_y = y - SLOT_SIZE - 5
-        for i, (slot_status) in enumerate(entity.slots.values()):
-            obj_id = slot_status["object_id"]
+        for i, obj_id in enumerate(entity.slots.objects):
             slot_x = slot_x_start + i * (SLOT_SIZE + SLOT_MARGIN)
             color = SLOT_COLOR_EMPTY if obj_id is None else SLOT_COLOR_OCCUPIED
             pygame.draw.rect(self.screen, color, (slot_x, slot_y, SLOT_SIZE, SLOT_SIZE))
@@ -89,6 +89,9 @@ class Renderer:
         self.screen.fill(BG_COLOR)
         self.draw_pause_button()
         self.draw_reset_button()
+        if self.system.roadmap is not None:
+            for a, b in self.system.roadmap.edges:
+                pygame.draw.line(self.screen, ROADMAP_COLOR, self.system.roadmap.points[a], self.system.roadmap.points[b], 2)
         for station_id, station in self.system.stations.items():
             self.draw_entity(station, STATION_COLOR, station_id)
         for parking_id, parking in self.system.parkings.items():
@@ -113,6 +116,6 @@ class Renderer:
                     print(f"System {'paused' if self.system.paused else 'resumed'}")
                     # print(f"Simulation {'paused' if self.paused else 'resumed'}")
                 elif mouse_reset_dist <= BUTTON_RADIUS:
-                    if RESET_BUTTON_RECT.collidepoint(event.pos):
+                    if self.reset_rect.collidepoint(event.pos):
                         self.system.reset()
                         print("Simulation reset")
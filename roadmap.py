@@ -0,0 +1,58 @@
+import json
+import numpy as np
+
+class Roadmap:
+    """Aisle graph for travel distances and AMR paths, loaded from a layout file.
+
+    Layout JSON: {"nodes": {"A": [x, y], ...}, "edges": [["A", "B"], ["B", "C", length], ...]}. Edges are
+    two-way and default to their straight length. Stations and parkings dock at their nearest roadmap node
+    with a straight leg. All-pairs shortest paths are computed once with a vectorized Floyd-Warshall and
+    path polylines are cached per node pair, so runtime queries are lookups.
+    """
+    def __init__(self, nodes:dict, edges:list):
+        self.ids = list(nodes)
+        self.index = {node_id: index for index, node_id in enumerate(self.ids)}
+        self.points = np.array([nodes[node_id] for node_id in self.ids], dtype=float)
+        self.edges = []
+        count = len(self.ids)
+        distances = np.full((count, count), np.inf)
+        np.fill_diagonal(distances, 0.0)
+        for edge in edges:
+            if edge[0] not in self.index or edge[1] not in self.index:
+                raise Exception(f"Roadmap edge {edge[0]}-{edge[1]} uses an unknown node")
+            a, b = self.index[edge[0]], self.index[edge[1]]
+            length = float(edge[2]) if len(edge) > 2 else float(np.hypot(*(self.points[a] - self.points[b])))
+            distances[a, b] = distances[b, a] = min(distances[a, b], length)
+            self.edges.append((a, b))
+        # next_hop[i, j]: node after i on the shortest path to j
+        next_hop = np.where(np.isfinite(distances), np.arange(count)[None, :], -1)
+        for k in range(count):
+            through = distances[:, k, None] + distances[None, k, :]
+            shorter = through < distances
+            distances = np.where(shorter, through, distances)
+            next_hop = np.where(shorter, next_hop[:, k, None], next_hop)
+        self.distances = distances
+        self.next_hop = next_hop
+        self.paths = {}  # (start, end) -> (k, 2) polyline of node points
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            layout = json.load(file)
+        return cls(layout["nodes"], layout["edges"])
+
+    def nearest(self, points):
+        # index of the closest roadmap node to each of the (n, 2) points
+        delta = points[:, None, :] - self.points[None, :, :]
+        return np.argmin(np.hypot(delta[..., 0], delta[..., 1]), axis=1)
+
+    def path(self, start, end):
+        polyline = self.paths.get((start, end))
+        if polyline is None:
+            if not np.isfinite(self.distances[start, end]):
+                raise Exception(f"No roadmap path from {self.ids[start]} to {self.ids[end]}")
+            nodes = [start]
+            while nodes[-1] != end:
+                nodes.append(self.next_hop[nodes[-1], end])
+            polyline = self.paths[(start, end)] = self.points[nodes]
+        return polyline
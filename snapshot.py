@@ -0,0 +1,135 @@
+import threading
+from classes import *
+
+def order_view(order:Order):
+    return {
+        "id": str(order.order_id),
+        "object_id": order.object_id,
+        "source_station": order.source_station.id,
+        "destination_station": order.destination_station.id,
+        "status": order.status,
+        "pickup_id": str(order.suborders["pickup"].suborder_id),
+        "delivery_id": str(order.suborders["delivery"].suborder_id),
+        "allow_grouping": order.allow_grouping,
+        "priority": order.priority,
+        "created_at": order.created_at
+    }
+
+def suborder_view(suborder:SubOrder):
+    return {
+        "id": str(suborder.suborder_id),
+        "order_id": str(suborder.order_id),
+        "type": suborder.type,
+        "station_id": suborder.station_id,
+        "object_id": suborder.object_id,
+        "status": suborder.status,
+        "allow_grouping": suborder.allow_grouping,
+        "priority": suborder.priority
+    }
+
+def task_view(task:Task):
+    suborder_description = []
+    for suborder in task.suborders:
+        suborder_description.append(f"{suborder.suborder_id}: {suborder.type} {suborder.object_id} {'to' if suborder.type == 'delivery' else 'from'} {suborder.station_id}")
+    return {
+        "id": str(task.id),
+        "assigned_amr": task.assigned_amr,
+        "status": task.status,
+        "station": task.station.id,
+        "suborders": [str(suborder.suborder_id) for suborder in task.suborders],
+        "suborder_description": suborder_description
+    }
+
+class Snapshot:
+    # Read-only view of the system published by step(); sections are never mutated after publish
+    __slots__ = ("version", "clock", "sections", "versions", "bodies")
+
+    def __init__(self, version, clock, sections, versions, bodies):
+        self.version = version
+        self.clock = clock
+        self.sections = sections  # section -> payload
+        self.versions = versions  # section -> version of the last change
+        self.bodies = bodies      # section -> serialized response, filled lazily by the API
+
+    def etag(self, section):
+        return f"{section}-{self.versions[section]}"
+
+    def body(self, section, serialize):
+        body = self.bodies.get(section)
+        if body is None:
+            body = self.bodies[section] = serialize(self.sections[section])
+        return body
+
+class SnapshotPublisher:
+    """Publishes a versioned Snapshot of orders, suborders, tasks and AMR queues for the read API.
+
+    Snapshots are only built by the sim thread at the end of a step, after a reader asked for one.
+    Steps nobody asked for mark the snapshot stale, and the next read waits for the following step
+    to publish instead of returning it. Readers never build or touch live state. Sections equal to
+    the previous snapshot keep their version, payload and serialized body.
+    """
+    def __init__(self, system):
+        self.system = system
+        self.version = 0  # monotonic across MedibotSystem.reset() so ETags never repeat
+        self.snapshot = Snapshot(0, 0, {}, {}, {})
+        self.condition = threading.Condition()  # guards wanted/stale, notified on publish
+        self.wanted = True
+        self.stale = False  # steps ran since the last publish
+
+    def read(self, timeout=SNAPSHOT_WAIT):
+        # API threads only; falls back to the stale snapshot if no step runs within timeout
+        with self.condition:
+            self.wanted = True
+            if self.stale:
+                self.condition.wait_for(lambda: not self.stale, timeout)
+            return self.snapshot
+
+    def defer(self):
+        # Called by step() instead of publish(), marks the snapshot stale and returns True if no reader asked for one
+        with self.condition:
+            if self.wanted:
+                return False
+            self.stale = True
+            return True
+
+    def build_sections(self):
+        system = self.system
+        sections = {
+            "orders": {str(order_id): order_view(order) for order_id, order in system.orders.items()},
+            "suborders": {str(suborder_id): suborder_view(suborder) for suborder_id, suborder in system.suborders.items()},
+            "tasks": {str(task_id): task_view(task) for task_id, task in system.tasks.items()},
+        }
+        for amr_id, queue in system.amr_queues.items():
+            system.update_expected_states(system.amrs[amr_id])
+            sections[f"queue:{amr_id}"] = {
+                "tasks": [task_view(task) for task in queue],
+                "expected_states": [sorted(state) for state in queue.expected_states()],
+            }
+        return sections
+
+    def publish(self, force=False):
+        # Sim thread only, caller holds db_lock
+        if not self.wanted and not force:
+            return self.snapshot
+        previous = self.snapshot
+        sections = self.build_sections()
+        versions = {}
+        bodies = {}
+        changed = False
+        for section, payload in sections.items():
+            if previous.sections.get(section) == payload:
+                sections[section] = previous.sections[section]
+                versions[section] = previous.versions[section]
+                if section in previous.bodies:
+                    bodies[section] = previous.bodies[section]
+                continue
+            if not changed:
+                self.version += 1
+                changed = True
+            versions[section] = self.version
+        with self.condition:
+            self.snapshot = Snapshot(self.version, self.system.clock, sections, versions, bodies)
+            self.wanted = False
+            self.stale = False
+            self.condition.notify_all()
+        return self.snapshot
@@ -2,78 +2,157 @@ import random
 import numpy as np
 import threading
 import time
-import copy
+import bisect
+import heapq
+import math
+import collections
+import itertools
+import queue
+import os
 from configs import *
 from classes import *
-from functions import _distance, arrage_positions, promote_element
-from flask_app import create_flask_app, run_flask
-from pygame_renderer import Renderer
+from functions import arrage_positions, promote_element, linear_sum_assignment
+from engine import DiscreteEventEngine
+from eventlog import logger, enable_console, set_level
+from profiler import StepProfiler
+from snapshot import SnapshotPublisher, order_view, suborder_view, task_view
+from history import History, HistoryStore, new_run_id
+from stream import StateStream
+from checkpoint import Checkpointer
+from optimizer import QueueOptimizer
+from roadmap import Roadmap
+from time import perf_counter
 from typing import Union
-from icecream import ic
-from rich import print as rp
+import logging
 
-ic.configureOutput(includeContext=True)
+# Mutable state written to checkpoints; derived caches (distance matrix) are rebuilt on restore
+CHECKPOINT_ATTRIBUTES = ["config", "task_counter", "suboder_counter", "tasks", "orders", "suborders", "orders_history", "suborders_history",
+                         "tasks_history", "history_run_id", "amrs", "amr_queues", "queue_costs", "station_queues", "objects",
+                         "object_orders", "rejected_orders", "stations", "parkings", "clock", "timestamp_counter",
+                         "amr_positions", "amr_goals", "amr_moving", "move_requests", "amr_travelled", "goal_claims", "amr_goal_claims",
+                         "roadmap", "amr_routes", "amr_route_progress"]
 
 class MedibotSystem:
-    def __init__(self, render=False):
+    def __init__(self, render=False, config=None):
+        self.config = config if config is not None else SystemConfig()
+        self.rng = random.Random(self.config.seed) if self.config.seed is not None else random  # object spawn in reset()
+        self.roadmap = Roadmap.load(self.config.roadmap) if self.config.roadmap else None
+        self.profiler = StepProfiler()  # survives reset() so /medibot/profile keeps its history
+        self.snapshots = SnapshotPublisher(self)  # read API state, versions keep increasing across reset()
+        self.stream = StateStream(self)  # per-step diffs, sequence numbers keep increasing across reset()
+        # opened on the first spill, a file of its own so concurrent systems and restarts never share one
+        self.history_store = HistoryStore(os.path.join(HISTORY_DB, f"history-{os.getpid()}-{new_run_id()}.sqlite3")) if HISTORY_DB else None
+        self.checkpointer = None  # set by enable_checkpoints()
         self.reset()
         self.render_flag = render
         self.paused = False
 
     def reset(self):
         self.task_counter = 0
-        self.order_counter = 0
+        self.order_id_lock = threading.Lock()  # API threads allocate ids without db_lock
+        self.next_order_id = 1
+        self.queued_order_ids = set()        # submitted ids still in the inbox
+        self.inbox = queue.SimpleQueue()     # (order_id, order request) submitted by the API, drained by step()
+        self.rejected_orders = collections.OrderedDict()  # order_id -> result of rejected submissions, bounded
         self.suboder_counter = 0
         self.tasks = {}
         self.orders = {}
+        self.pending_orders = []  # heap of (priority, created_at, order_id) of orders waiting for an AMR, most urgent first
+        self.blocked_orders = set()  # order_ids no AMR queue had room for, back in pending_orders once a task completes
+        self.order_counts = collections.Counter()  # status -> live orders
+        self.changed_orders = set()  # order_ids with a suborder completed or failed since the last step
         self.suborders = {}
-        self.orders_history = {}
-        self.suborders_history = {}
-        self.tasks_history = {}
+        # bounded, older records are spilled to self.history_store under a per-reset run id
+        self.history_run_id = new_run_id()
+        self.orders_history = History("orders", order_view, self.history_store, self.history_run_id, self.current_clock)
+        self.suborders_history = History("suborders", suborder_view, self.history_store, self.history_run_id, self.current_clock)
+        self.tasks_history = History("tasks", task_view, self.history_store, self.history_run_id, self.current_clock)
         self.amrs = {}
-        self.amr_queues = {}
+        self.amr_queues = {}             # amr_id -> TaskQueue
+        self.amr_task_counts = {}        # amr_id -> Counter of live task statuses
+        self.completed_tasks = set()     # ids of completed tasks not yet moved to the history
+        self.state_changed_at = 0        # last tick a slot, task, suborder or queue changed, what sleeping tasks wait on
+        self.sleep_checked_at = {}       # amr_id -> last tick wake_task found none of its sleeping tasks could run
+        self.queue_costs = {}            # amr_id -> QueueCosts, invalidated together with the expected states
         self.station_queues = {}
-        self.objects = {}
+        self.objects = {}         # object_id -> (location, slot index), kept current on every transfer
+        self.object_orders = {}   # object_id -> order_id of the live order moving it
         self.stations = {}
         self.parkings = {}
         self.db_lock = threading.Lock()
-
-        amr_positions = self.arrange_parking_positions(FLEET_SIZE)
-        for i in range(FLEET_SIZE):
+        self.clock = 0  # virtual time in ticks, advanced by step() and the event engine
+        self.timestamp_counter = 0
+        self.engine = DiscreteEventEngine(self)
+        self.optimizer = self.create_optimizer()  # a search still running for the previous state is dropped with it
+
+        # Fleet kinematics live in contiguous arrays, AMR.position/goal/is_moving are views into them
+        config = self.config
+        self.amr_positions = np.zeros((config.fleet_size, 2))
+        self.amr_goals = np.zeros((config.fleet_size, 2))
+        self.amr_moving = np.zeros(config.fleet_size, dtype=bool)
+        self.move_requests = np.zeros(config.fleet_size, dtype=bool)
+        self.amr_travelled = np.zeros(config.fleet_size)  # odometer of every AMR
+        self.goal_claims = {}      # station/parking id -> sorted [(goal_timestamp, amr_id)] of AMRs heading there
+        self.amr_goal_claims = {}  # amr_id -> (node id, claim) of its current goal
+        # roadmap only: (points, cumulative lengths) of the path each AMR follows to its goal, and how far along it is
+        self.amr_routes = [None] * config.fleet_size
+        self.amr_route_progress = np.zeros(config.fleet_size)
+
+        amr_positions = self.arrange_parking_positions(config.fleet_size)
+        for i in range(config.fleet_size):
             amr_id = f"AMR{i}"
             self.register_entity(AMR, amr_id, amr_positions[i])
             parking_id = f"Parking{i}"
             self.parkings[amr_id] = Parking(parking_id, amr_positions[i].x, amr_positions[i].y)
-            self.amrs[amr_id].parked = True
 
-        station_positions = self.arrange_station_positions(TOTAL_STATIONS)
-        for i in range(TOTAL_STATIONS):
+        station_positions = self.arrange_station_positions(config.total_stations)
+        for i in range(config.total_stations):
             self.register_entity(Station, f"Station{i}", station_positions[i])
+        self.build_distance_matrix()
 
-        available_locations = [(station_id, slot_id) for station_id, station in self.stations.items()
-                                for slot_id, obj in station.slots.items() if obj["object_id"] is None]
-        if len(available_locations) < OBJECTS:
+        available_locations = [(station_id, slot) for station_id, station in self.stations.items()
+                                for slot in station.slots.free]
+        if len(available_locations) < config.objects:
             raise Exception("Not enough empty station slots to spawn all objects uniquely.")
-        random.shuffle(available_locations)
-        for i in range(OBJECTS):
+        self.rng.shuffle(available_locations)
+        for i in range(config.objects):
             if i<9:
                 object_id = f"Object0{i+1}"
             else:
                 object_id = f"Object{i+1}"
-            station_id, slot_id = available_locations[i]
-            self.add_object(object_id, station_id, slot_id)
-            # rp(f"{object_id} spawned at {station_id} {slot_id}.")
+            station_id, slot = available_locations[i]
+            self.add_object(object_id, station_id, slot)
+            # logger.debug(f"{object_id} spawned at {station_id} slot_{slot}.")
+        with self.db_lock:
+            self.snapshots.publish(force=True)
+
+    def create_optimizer(self):
+        if not self.config.optimizer_interval:
+            return None
+        return QueueOptimizer(self, self.config.optimizer_interval, self.config.optimizer_thread)
+
+    def current_clock(self):
+        return self.clock
+
+    def timestamp(self):
+        # (virtual tick, sequence) so goals claimed within the same tick keep their claim order
+        self.timestamp_counter += 1
+        return (self.clock, self.timestamp_counter)
 
     def register_entity(self, entity_class, entity_id:str, position:Position):
         if entity_class!=AMR and entity_class!=Station and entity_class!=Parking:
             raise Exception("Invalid entity class.")
-        entity = entity_class(entity_id, position.x, position.y)
         if entity_class==AMR:
+            entity = AMR(entity_id, position.x, position.y, capacity=self.config.amr_slot_capacity)
+            entity.bind(self.amr_positions, self.amr_goals, self.amr_moving, len(self.amrs))
             self.amrs[entity_id] = entity
-            self.amr_queues[entity_id] = {"tasks": [], "expected_states": []}
+            self.amr_queues[entity_id] = TaskQueue()
+            self.amr_task_counts[entity_id] = collections.Counter()
+            self.queue_costs[entity_id] = QueueCosts(self.config.total_stations)
         elif entity_class==Station:
+            entity = Station(entity_id, position.x, position.y, capacity=self.config.station_slot_capacity)
             self.stations[entity_id] = entity
-        # rp(f"{entity_id} registered at {position.x}, {position.y}.")
+        # logger.debug(f"{entity_id} registered at {position.x}, {position.y}.")
     
     def arrange_parking_positions(self, amr_count, spacing=50):
         positions = []
@@ -97,111 +176,333 @@ class MedibotSystem:
 
         return left_positions + right_positions
 
-    def add_object(self, object_id, location:str, slot:str):
-        self.objects[object_id] = (location, slot)
+    def add_object(self, object_id, location:str, slot:int):
         if location in self.amrs.keys():
-            self.amrs[location].slots[slot]["object_id"] = object_id
+            self.set_slot_object(self.amrs[location], slot, object_id)
         elif location in self.stations.keys():
-            self.stations[location].slots[slot]["object_id"] = object_id
+            self.set_slot_object(self.stations[location], slot, object_id)
         else:
             raise Exception("Invalid location")
 
-    def add_order(self, object_id:str, source_station:str, destination_station:str, allow_grouping=True, priority=100):
-        success = False
+    def set_slot_object(self, device:Union[Station, AMR], slot:int, object_id):
+        # Single write path for slot contents, keeps self.objects and the device slot table consistent
+        table = device.slots
+        previous_object_id = table.objects[slot]
+        if previous_object_id is not None:
+            table.held.discard(previous_object_id)
+            if self.objects.get(previous_object_id) == (device.id, slot):
+                del self.objects[previous_object_id]
+            bisect.insort(table.free, slot)
+        if object_id is not None:
+            table.held.add(object_id)
+            self.objects[object_id] = (device.id, slot)
+            table.free.remove(slot)
+        table.objects[slot] = object_id
+        self.state_changed_at = self.clock
+
+    def reserve_slot(self, device:Union[Station, AMR], slot:int, order_id):
+        table = device.slots
+        if order_id in table.reservations[slot]:
+            return False
+        table.reservations[slot] += (order_id,)
+        table.reserved[order_id] = slot
+        return True
+
+    def release_reservation(self, device:Union[Station, AMR], slot:int, order_id):
+        table = device.slots
+        reservations = list(table.reservations[slot])
+        reservations.remove(order_id)
+        table.reservations[slot] = tuple(reservations)
+        if table.reserved.get(order_id) == slot:
+            del table.reserved[order_id]
+
+    def allocate_order_id(self):
+        with self.order_id_lock:
+            order_id = self.next_order_id
+            self.next_order_id += 1
+        return order_id
+
+    def submit_orders(self, items:list):
+        """Queue order requests for the next step() without taking db_lock, returns one result per item.
+
+        The shape, priority and stations of each item are checked here and failures are returned with their
+        reason; objects and duplicates need the live state, they are validated when step() drains the inbox
+        and rejected ids are reported by intake_status().
+        """
+        results = []
+        accepted = []
+        for item in items:
+            if not isinstance(item, dict) or not all(isinstance(item.get(key), str) for key in ["object_id", "source_station", "destination_station"]):
+                results.append({"message": "Invalid order: object_id, source_station and destination_station are required", "success": False})
+                continue
+            message = self.validate_request(item["source_station"], item["destination_station"], item.get("priority", 100))
+            if message is not None:
+                results.append({"message": message, "success": False})
+                continue
+            order_id = self.allocate_order_id()
+            accepted.append((order_id, {key: item[key] for key in ["object_id", "source_station", "destination_station", "allow_grouping", "priority"] if key in item}))
+            results.append({"message": f"Order {order_id} accepted.", "success": True, "order_id": str(order_id)})
+        if self.checkpointer is not None and accepted:
+            self.checkpointer.log_orders(accepted)  # write-ahead, before step() can see the orders
+        for order_id, item in accepted:
+            self.queued_order_ids.add(order_id)
+            self.inbox.put((order_id, item))
+        return results
+
+    def drain_inbox(self):
+        # Caller holds db_lock; creates the submitted orders in submission order
+        while True:
+            try:
+                order_id, item = self.inbox.get_nowait()
+            except queue.Empty:
+                return
+            message = self.validate_order(item["object_id"], item["source_station"], item["destination_station"], item.get("priority", 100))
+            if message is not None:
+                logger.warning("Order %s rejected. %s", order_id, message)
+                self.rejected_orders[order_id] = {"message": message, "success": False, "order_id": str(order_id)}
+                if len(self.rejected_orders) > INTAKE_HISTORY:
+                    self.rejected_orders.popitem(last=False)
+            else:
+                self.create_order(item["object_id"], item["source_station"], item["destination_station"],
+                                  item.get("allow_grouping", True), item.get("priority", 100), order_id=order_id)
+            self.queued_order_ids.discard(order_id) # after the order exists, so intake_status never misses it
+
+    def enable_checkpoints(self, path, interval=CHECKPOINT_INTERVAL, restore=False):
+        """Checkpoint to path every interval ticks and log submitted orders ahead, optionally resuming from path first."""
+        self.checkpointer = Checkpointer(self, path, interval)
+        if self.history_store is not None and self.history_store.connection is None:
+            # spilled records must survive a restart together with the checkpoint that refers to them
+            self.history_store = HistoryStore(path + ".history.sqlite3")
+            for history in [self.orders_history, self.suborders_history, self.tasks_history]:
+                history.store = self.history_store
+        if restore and os.path.exists(path):
+            self.checkpointer.restore()
+        return self.checkpointer
+
+    def checkpoint_state(self):
+        # Caller holds db_lock between steps
+        state = {name: getattr(self, name) for name in CHECKPOINT_ATTRIBUTES}
+        with self.order_id_lock:
+            state["next_order_id"] = self.next_order_id  # read only, checkpoints must not change the ids orders get
+        state["order_events"] = self.engine.order_events
+        state["event_counter"] = self.engine.event_counter
+        return state
+
+    def restore_state(self, state):
+        with self.db_lock:
+            for name in CHECKPOINT_ATTRIBUTES:
+                setattr(self, name, state[name])
+            with self.order_id_lock:
+                self.next_order_id = state["next_order_id"]
+            self.engine.order_events = state["order_events"]
+            self.engine.event_counter = state["event_counter"]
+            for history in [self.orders_history, self.suborders_history, self.tasks_history]:
+                history.store = self.history_store
+                history.clock = self.current_clock
+            self.inbox = queue.SimpleQueue()
+            self.queued_order_ids = set()
+            self.build_distance_matrix()
+            self.rebuild_pending_orders()
+            self.blocked_orders = set()
+            self.rebuild_status_indexes()
+            self.sleep_checked_at = {}
+            self.optimizer = self.create_optimizer()
+            self.stream.invalidate()
+            self.snapshots.publish(force=True)
+
+    def replay_orders(self, entries):
+        # Resubmit write-ahead logged orders unknown to the restored state under their original ids
+        resubmitted = 0
+        last_order_id = 0
+        for entry in entries:
+            order_id = entry.pop("order_id")
+            last_order_id = max(last_order_id, order_id)
+            if order_id in self.orders or order_id in self.rejected_orders or self.orders_history.get(order_id) is not None:
+                continue
+            self.queued_order_ids.add(order_id)
+            self.inbox.put((order_id, entry))
+            resubmitted += 1
+        with self.order_id_lock:
+            self.next_order_id = max(self.next_order_id, last_order_id + 1)
+        return resubmitted
+
+    def intake_status(self, order_id:int):
+        if order_id in self.orders:
+            return {"order_id": str(order_id), "status": self.orders[order_id].status}
+        order = self.orders_history.get(order_id)
+        if order is not None:
+            return {"order_id": str(order_id), "status": order.status}
+        if order_id in self.rejected_orders:
+            return {"order_id": str(order_id), "status": "rejected", "message": self.rejected_orders[order_id]["message"]}
+        if order_id in self.queued_order_ids:
+            return {"order_id": str(order_id), "status": "queued"}
+        return None
+
+    def validate_request(self, source_station:str, destination_station:str, priority=100):
+        # Error message of the checks that do not depend on live state, None if they pass. Needs no db_lock.
+        if isinstance(priority, bool) or not isinstance(priority, (int, float)):
+            return f"Invalid order: priority {priority!r} must be a number"
         if source_station == destination_station:
-            message = f"Invalid order: {source_station} and {destination_station} must be different"
-            rp(message)
-            return {"message": message, "success": success}
+            return f"Invalid order: {source_station} and {destination_station} must be different"
         for station_id in [source_station, destination_station]:
             if station_id not in self.stations.keys():
-                message = f"Invalid order: {object_id} is being processed by order {current_order_id}"
-                rp(message)
-                return {"message": message, "success": success}
+                return f"Invalid order: {station_id} is not a station"
             if not isinstance(self.stations[station_id], Station):
-                message = f"Unexpected station type {type(self.stations[station_id])}"
-                return {"message": message, "success": success}
-        
-        for current_order_id, current_order in self.orders.items():
-            if not isinstance(current_order, Order):
-                message = f"Unexpected order type {type(current_order)}"
-                rp(message)
-                return {"message": message, "success": success}
-            if current_order.object_id == object_id:
-                message = f"Invalid order: {object_id} is being processed by order {current_order_id}"
-                rp(message)
-                return {"message": message, "success": success}
-        
-        source_station = self.stations[source_station]
-        destination_station = self.stations[destination_station]
-        source_slots = source_station.slots.values()
-        if not any([slot["object_id"] == object_id for slot in source_slots]):
-            message = f"Invalid order: {object_id} not found in {source_station.id}"
-            rp(message)
-            return {"message": message, "success": success}
+                return f"Unexpected station type {type(self.stations[station_id])}"
+        return None
+
+    def validate_order(self, object_id:str, source_station:str, destination_station:str, priority=100):
+        # Error message of an order request, None if it can be created. Caller holds db_lock.
+        message = self.validate_request(source_station, destination_station, priority)
+        if message is not None:
+            return message
+        if object_id in self.object_orders:
+            return f"Invalid order: {object_id} is being processed by order {self.object_orders[object_id]}"
+        if self.objects.get(object_id, (None, None))[0] != source_station:
+            return f"Invalid order: {object_id} not found in {source_station}"
+        return None
 
+    def add_order(self, object_id:str, source_station:str, destination_station:str, allow_grouping=True, priority=100):
         with self.db_lock:
-            self.order_counter += 1
-            order_id = str(self.order_counter)
-            self.orders[order_id] = Order(order_id=order_id, 
-                                            object_id=object_id, 
-                                            source_station=source_station, 
-                                            destination_station=destination_station, 
-                                            allow_grouping=allow_grouping, 
-                                            priority=priority)
-            new_order = self.orders[order_id]
-            self.suboder_counter += 1
-            source_suborder_id = str(self.suboder_counter)
-            self.suborders[source_suborder_id] = SubOrder(suborder_id=source_suborder_id, 
+            message = self.validate_order(object_id, source_station, destination_station, priority)
+            if message is not None:
+                logger.warning(message)
+                return {"message": message, "success": False}
+            return self.create_order(object_id, source_station, destination_station, allow_grouping, priority)
+
+    def create_order(self, object_id:str, source_station:str, destination_station:str, allow_grouping=True, priority=100, order_id=None):
+        # Caller holds db_lock and has validated the order
+        source_station = self.stations[source_station]
+        destination_station = self.stations[destination_station]
+        if order_id is None:
+            order_id = self.allocate_order_id()
+        self.orders[order_id] = Order(order_id=order_id, 
+                                        object_id=object_id, 
+                                        source_station=source_station, 
+                                        destination_station=destination_station, 
+                                        allow_grouping=allow_grouping, 
+                                        priority=priority,
+                                        created_at=self.clock)
+        new_order = self.orders[order_id]
+        self.order_counts[new_order.status] += 1
+        self.object_orders[object_id] = order_id
+        self.suboder_counter += 1
+        source_suborder_id = self.suboder_counter
+        self.suborders[source_suborder_id] = SubOrder(suborder_id=source_suborder_id, 
+                                                        order_id=order_id, 
+                                                        sub_type="pickup", 
+                                                        station_id=source_station.id, 
+                                                        object_id=object_id, 
+                                                        allow_grouping=allow_grouping, 
+                                                        priority=priority)
+        self.suboder_counter += 1
+        destination_suborder_id = self.suboder_counter
+        self.suborders[destination_suborder_id] = SubOrder(suborder_id=destination_suborder_id, 
                                                             order_id=order_id, 
-                                                            sub_type="pickup", 
-                                                            station_id=source_station.id, 
+                                                            sub_type="delivery", 
+                                                            station_id=destination_station.id, 
                                                             object_id=object_id, 
                                                             allow_grouping=allow_grouping, 
                                                             priority=priority)
-            self.suboder_counter += 1
-            destination_suborder_id = str(self.suboder_counter)
-            self.suborders[destination_suborder_id] = SubOrder(suborder_id=destination_suborder_id, 
-                                                                order_id=order_id, 
-                                                                sub_type="delivery", 
-                                                                station_id=destination_station.id, 
-                                                                object_id=object_id, 
-                                                                allow_grouping=allow_grouping, 
-                                                                priority=priority)
-            new_order.suborders["pickup"] = self.suborders[source_suborder_id]
-            new_order.suborders["delivery"] = self.suborders[destination_suborder_id]
-            
-            success = True
-            message = f"Order {order_id} created."
-            rp(message)
-            return {"message": message, "success": success, "order_id": order_id}
+        new_order.suborders["pickup"] = self.suborders[source_suborder_id]
+        new_order.suborders["delivery"] = self.suborders[destination_suborder_id]
+        heapq.heappush(self.pending_orders, (priority, new_order.created_at, order_id))
+        self.release_blocked_orders(source_station.id) # its pickup will free a slot there
+        
+        message = f"Order {order_id} created."
+        logger.info(message)
+        return {"message": message, "success": True, "order_id": str(order_id)}
     
+    def set_goal(self, amr:AMR, node:Union[Station, Parking], timestamp=None):
+        # the only writer of amr.goal once the system runs, so goal_claims stays current; timestamp=None keeps the claim time
+        if timestamp is not None:
+            amr.goal_timestamp = timestamp
+        claim = (amr.goal_timestamp or (-1, -1), amr.id)  # no timestamp only happens for the AMR's own parking
+        current = self.amr_goal_claims.get(amr.id)
+        if current != (node.id, claim):
+            if current is not None:
+                claims = self.goal_claims[current[0]]
+                claims.remove(current[1])
+                if not claims:
+                    del self.goal_claims[current[0]]
+            bisect.insort(self.goal_claims.setdefault(node.id, []), claim)
+            self.amr_goal_claims[amr.id] = (node.id, claim)
+            if self.roadmap is not None:
+                self.plan_route(amr, node)
+        amr.goal = node.position
+
+    def plan_route(self, amr:AMR, node:Union[Station, Parking]):
+        # current position -> nearest roadmap node -> cached shortest path -> dock of node -> node
+        start = self.amr_positions[amr.index].copy()
+        path = self.roadmap.path(self.roadmap.nearest(start[None, :])[0], self.node_docks[node.index])
+        points = np.vstack([start, path, [node.position.x, node.position.y]])
+        keep = np.ones(len(points), dtype=bool)
+        keep[1:] = np.any(points[1:] != points[:-1], axis=1)  # np.interp needs increasing lengths
+        points = points[keep]
+        lengths = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))])
+        self.amr_routes[amr.index] = (points, lengths)
+        self.amr_route_progress[amr.index] = 0.0
+
+    def remaining_distance(self, amr:AMR):
+        if self.roadmap is None:
+            delta = self.amr_goals[amr.index] - self.amr_positions[amr.index]
+            return math.hypot(delta[0], delta[1])
+        return self.amr_routes[amr.index][1][-1] - self.amr_route_progress[amr.index]
+
+    def goal_blocker(self, amr:AMR):
+        # AMR that claimed the same goal earlier, None if amr may move
+        current = self.amr_goal_claims.get(amr.id)
+        if current is None:
+            return None
+        first = self.goal_claims[current[0]][0]
+        return None if first == current[1] else first[1]
+
     def move_to_goal(self, amr:AMR):
-        for other_amr_id, other_amr in self.amrs.items():
-            if not isinstance(other_amr, AMR):
-                raise Exception("Unexpected amr type.")
-            if amr.id == other_amr_id:
-                continue
-            if other_amr.goal == amr.goal and other_amr.goal_timestamp <= amr.goal_timestamp:
-                rp(f"{other_amr_id} already at {other_amr.goal.x}, {other_amr.goal.y}, {amr.id} waiting.")
-                return
-        dx = amr.goal.x - amr.position.x
-        dy = amr.goal.y - amr.position.y
-        distance = np.hypot(dx, dy)
-        if distance == 0:
-            return  # Already at goal
-        step = min(STEP_DISTANCE, distance)
-        unit_vector = (dx / distance, dy / distance)
-        amr.position.x += unit_vector[0] * step
-        amr.position.y += unit_vector[1] * step
+        blocker = self.goal_blocker(amr)
+        if blocker is not None:
+            logger.debug("%s already at %s, %s, %s waiting.", blocker, amr.goal.x, amr.goal.y, amr.id)
+            return
+        # the actual motion is applied for the whole fleet at once in move_fleet()
+        self.move_requests[amr.index] = True
+
+    def move_fleet(self, steps=1, movers=None):
+        movers = self.move_requests if movers is None else movers
+        if not movers.any():
+            return
+        if self.roadmap is not None:
+            for index in np.flatnonzero(movers):
+                points, lengths = self.amr_routes[index]
+                progress = min(self.amr_route_progress[index] + self.config.step_distance * steps, lengths[-1])
+                self.amr_travelled[index] += progress - self.amr_route_progress[index]
+                self.amr_route_progress[index] = progress
+                self.amr_positions[index] = (np.interp(progress, lengths, points[:, 0]), np.interp(progress, lengths, points[:, 1]))
+            movers[:] = False
+            return
+        delta = self.amr_goals[movers] - self.amr_positions[movers]
+        distance = np.hypot(delta[:, 0], delta[:, 1])
+        step = np.minimum(self.config.step_distance * steps, distance)
+        scale = np.divide(step, distance, out=np.zeros_like(distance), where=distance > 0)
+        self.amr_positions[movers] += delta * scale[:, None]
+        self.amr_travelled[movers] += step
+        movers[:] = False
+
+    def at_goal(self, amr:AMR):
+        # np.allclose(position, goal, atol=0.01) without building per-AMR lists
+        position = self.amr_positions[amr.index]
+        goal = self.amr_goals[amr.index]
+        return abs(position[0] - goal[0]) <= 0.01 + 1e-5 * abs(goal[0]) and abs(position[1] - goal[1]) <= 0.01 + 1e-5 * abs(goal[1])
 
     def find_object_in_slots(self, device:Union[Station, AMR], object_id:str):
-        return next((slot_id for slot_id, slot in device.slots.items() if slot["object_id"] == object_id), None)
+        location = self.objects.get(object_id)
+        if location is None or location[0] != device.id:
+            return None
+        return location[1]
 
     def find_available_slot(self, device:Union[Station, AMR]):
-        return next((slot_id for slot_id, slot_object in device.slots.items() if slot_object["object_id"] is None), None)
+        return device.slots.free[0] if device.slots.free else None
 
     def get_reserved_slot(self, device:Union[Station, AMR], order_id):
-        return next((slot_id for slot_id, slot_object in device.slots.items() if order_id in slot_object["reservation"]), None)
+        return device.slots.reserved.get(order_id)
 
     def sort_alternating_suborders(self, task_id):
         task = self.tasks[task_id]
@@ -209,8 +510,8 @@ class MedibotSystem:
         station = task.station
         pickups = [s for s in task.suborders if s.type == "pickup" and s.status == "pending"]
         deliveries = [s for s in task.suborders if s.type == "delivery" and s.status == "pending"]
-        station_available = sum(1 for s in station.slots.values() if s["object_id"] is None)
-        amr_available = sum(1 for s in self.amrs[amr_id].slots.values() if s["object_id"] is None)
+        station_available = len(station.slots.free)
+        amr_available = len(self.amrs[amr_id].slots.free)
         new_order = []
         if station_available < amr_available:
             while pickups or deliveries:
@@ -225,6 +526,8 @@ class MedibotSystem:
                 if pickups:
                     new_order.append(pickups.pop(0))
 
+        if len(new_order) != len(task.suborders):
+            self.mark_task_dirty(task) # non-pending suborders were dropped
         task.suborders = new_order
 
     def rearrange_suborders(self, task_id, amr_id):
@@ -233,27 +536,27 @@ class MedibotSystem:
         suborders = task.suborders
         pending_pickups = [s for s in suborders if s.type == "pickup" and s.status == "pending"]
         pending_deliveries = [s for s in suborders if s.type == "delivery" and s.status == "pending"]
-        station_available = sum(1 for s in station.slots.values() if s["object_id"] is None)
-        amr_available = sum(1 for s in self.amrs[amr_id].slots.values() if s["object_id"] is None)
+        station_available = len(station.slots.free)
+        amr_available = len(self.amrs[amr_id].slots.free)
 
         # Deadlock condition: both full
         if station_available == 0 and amr_available == 0:
-            rp(amr_id, station.id, suborders)
+            logger.error("Deadlock at %s for %s: %s", station.id, amr_id, [suborder.suborder_id for suborder in suborders])
             raise Exception("Deadlock: Station and AMR are full.")
         # Station full: must prioritize pickup to free space
         if station_available == 0 and amr_available > 0:
-            rp("Station full. Prioritizing pickup.")
+            logger.debug("Station full. Prioritizing pickup.")
             if pending_pickups:
                 promote_element(pending_pickups[0], suborders)
-                rp(f"Suborder {pending_pickups[0].suborder_id} is promoted.")
+                logger.debug("Suborder %s is promoted.", pending_pickups[0].suborder_id)
             else:
                 raise Exception("Deadlock: No pickup available to free station slot.")
         # AMR full: must prioritize delivery to free space
         elif amr_available == 0 and station_available > 0:
-            rp("AMR full. Prioritizing delivery.")
+            logger.debug("AMR full. Prioritizing delivery.")
             if pending_deliveries:
                 promote_element(pending_deliveries[0], suborders)
-                rp(f"Suborder {pending_deliveries[0].suborder_id} is promoted.")
+                logger.debug("Suborder %s is promoted.", pending_deliveries[0].suborder_id)
             else:
                 raise Exception("Deadlock: No delivery available to free AMR slot.")
 
@@ -264,10 +567,10 @@ class MedibotSystem:
                 # Alternate starting from pickup
                 if len(pending_pickups) >= len(pending_deliveries):
                     promote_element(pending_pickups[0], suborders)
-                    rp(f"Suborder {pending_pickups[0].suborder_id} is promoted.")
+                    logger.debug("Suborder %s is promoted.", pending_pickups[0].suborder_id)
                 else:
                     promote_element(pending_deliveries[0], suborders)
-                    rp(f"Suborder {pending_deliveries[0].suborder_id} is promoted.")
+                    logger.debug("Suborder %s is promoted.", pending_deliveries[0].suborder_id)
 
     def suborder_execution(self, amr:AMR):
         if not isinstance(amr, AMR):
@@ -285,179 +588,468 @@ class MedibotSystem:
         order_id = self.suborders[suborder_id].order_id
         
         if suborder.status == "pending":
-            rp("Rearranging suborders")
+            logger.debug("Rearranging suborders")
             self.rearrange_suborders(amr.task_id, amr.id)
-            self.update_expected_states(amr)
+            self.update_expected_states(amr) # no-op unless the queue changed, reordering keeps the states
 
-            rp(f"Executing suborder {suborder_id} for {amr.id}")
-            suborder.status = "executing"
+            logger.debug("Executing suborder %s for %s", suborder_id, amr.id)
+            self.set_suborder_status(suborder, "executing")
             if suborder.type == "pickup":
-                rp(f"Suborder is to pickup {suborder.object_id} from {suborder.station_id}")
+                logger.debug("Suborder is to pickup %s from %s", suborder.object_id, suborder.station_id)
                 suborder.station_slot = self.find_object_in_slots(station, suborder.object_id)
                 suborder.amr_slot = self.find_available_slot(amr)
                 
-                if not suborder.station_slot or not suborder.amr_slot:
-                    rp(f"Reserved slot for order {order_id} not found in AMR.") if not suborder.station_slot  else None
-                    rp(f"Object {suborder.object_id} not found in station {suborder.station_id}") if not suborder.amr_slot else None
-                    suborder.status = "failed"
+                if suborder.station_slot is None or suborder.amr_slot is None:
+                    if suborder.station_slot is None:
+                        logger.warning("Object %s not found in station %s", suborder.object_id, suborder.station_id)
+                    if suborder.amr_slot is None:
+                        logger.warning("No free slot for order %s in %s", order_id, amr.id)
+                    self.set_suborder_status(suborder, "failed")
                     amr.status = "error"
                     return
                 
             elif suborder.type == "delivery":
-                rp(f"Suborder is to deliver {suborder.object_id} to {suborder.station_id}")
+                logger.debug("Suborder is to deliver %s to %s", suborder.object_id, suborder.station_id)
                 suborder.amr_slot = self.find_object_in_slots(self.amrs[amr.id], suborder.object_id)
                 suborder.station_slot = self.get_reserved_slot(station, order_id)
-                if not suborder.station_slot or not suborder.amr_slot:
-                    rp(f"Reserved slot for order {order_id} not found in station.") if not suborder.station_slot else None
-                    rp(f"Object {suborder.object_id} not found in AMR {amr.id}") if not suborder.amr_slot else None
-                    suborder.status = "failed"
+                if suborder.station_slot is None or suborder.amr_slot is None:
+                    if suborder.station_slot is None:
+                        logger.warning("Reserved slot for order %s not found in station %s", order_id, suborder.station_id)
+                    if suborder.amr_slot is None:
+                        logger.warning("Object %s not found in %s", suborder.object_id, amr.id)
+                    self.set_suborder_status(suborder, "failed")
                     amr.status = "error"
                     return
             else:
                 raise Exception("Invalid suborder type.")
         
         elif suborder.status == "executing":
-            if suborder.timestep >= SUBORDER_DURATION:
+            if suborder.timestep >= self.config.suborder_duration:
                 if suborder.type == "pickup":
-                    amr.slots[suborder.amr_slot]["object_id"] = suborder.object_id
-                    station.slots[suborder.station_slot]["object_id"] = None
-                    station.slots[suborder.station_slot]["reservation"].remove(order_id)
-                    rp(f"Transferred {suborder.object_id} from {suborder.station_id} {suborder.station_slot} to {amr.id} {suborder.station_slot}")
+                    self.set_slot_object(amr, suborder.amr_slot, suborder.object_id)
+                    self.set_slot_object(station, suborder.station_slot, None)
+                    self.release_reservation(station, suborder.station_slot, order_id)
+                    logger.debug("Transferred %s from %s slot_%s to %s slot_%s", suborder.object_id, suborder.station_id, suborder.station_slot, amr.id, suborder.amr_slot)
                 elif suborder.type == "delivery":
-                    station.slots[suborder.station_slot]["object_id"] = suborder.object_id
-                    station.slots[suborder.station_slot]["reservation"].remove(order_id)
-                    amr.slots[suborder.amr_slot]["object_id"] = None
-                    rp(f"Transferred {suborder.object_id} from {amr.id} {suborder.amr_slot} to {suborder.station_id} {suborder.station_slot}")
-                self.suborders[suborder_id].status = "completed"
+                    self.set_slot_object(station, suborder.station_slot, suborder.object_id)
+                    self.release_reservation(station, suborder.station_slot, order_id)
+                    self.set_slot_object(amr, suborder.amr_slot, None)
+                    logger.debug("Transferred %s from %s slot_%s to %s slot_%s", suborder.object_id, amr.id, suborder.amr_slot, suborder.station_id, suborder.station_slot)
+                self.set_suborder_status(suborder, "completed")
             else:
                 suborder.timestep += 1
         return
 
-    def cost_based_assignment(self, order:Order):
-        cost_dict = {amr_id: {"cost": 0, "pickup_index": None, "delivery_index": None} for amr_id in self.amrs.keys()}
-        # Check possibilities
-        for amr_id, queue in self.amr_queues.items():
-            for task_index, task in enumerate(queue["tasks"]):
-                if not isinstance(task, Task):
-                    raise Exception("Unexpected task type.")
-                if task.status in ["completed", "failed"]:
-                    continue
-                if task.station != order.source_station:
-                    continue
-                # verify if this task can handle extra pickup
-                object_count = len(queue["expected_states"][task_index])
-                if object_count < AMR_SLOT_CAPACITY-1 and len(task.suborders)<=(AMR_SLOT_CAPACITY+STATION_SLOT_CAPACITY-2):
-                    rp(f"pickup suborder of order {order.order_id} can be assigned to queue{task_index} of {amr_id}")
-                    cost_dict[amr_id]["pickup_index"] = task_index
-                    break
-
-            if cost_dict[amr_id]["pickup_index"] != None:
-                for task in queue["tasks"][cost_dict[amr_id]["pickup_index"]:]: # start from index after pickup task
-                    if not isinstance(task, Task):
-                        raise Exception("Unexpected task type.")
-                    task_index = queue["tasks"].index(task)
-                    if task.station != order.destination_station:
-                        continue
-                    rp(f"delivery suborder of order {order.order_id} can be assigned to queue{task_index} of {amr_id}")
-                    cost_dict[amr_id]["delivery_index"] = task_index
-                    break
-                if cost_dict[amr_id]["delivery_index"] != None:
-                    continue
-
-            pickup_queue_index = cost_dict[amr_id]["pickup_index"]
-            delivery_queue_index = cost_dict[amr_id]["delivery_index"]
-            amr_cost = cost_dict[amr_id]["cost"]
-            # Cost calculation here
-            if len(queue["tasks"]) != 0:
-                # add the first station distance cost
-                amr_cost += _distance(self.amrs[amr_id].position, queue["tasks"][0].station.position) * DISTANCE_COST
-                amr_cost += len(queue["tasks"][0].suborders) * TRANSFER_COST
-            else:
-                amr_cost += _distance(self.amrs[amr_id].position, order.source_station.position) * DISTANCE_COST
-            
-            if pickup_queue_index != None and delivery_queue_index != None:
-                for task in queue["tasks"][1:delivery_queue_index]:
-                    task_index = queue["tasks"].index(task)
-                    amr_cost += _distance(task.station.position, queue["tasks"][task_index-1].station.position) * DISTANCE_COST
-                    amr_cost += len(task.suborders) * TRANSFER_COST
-            elif pickup_queue_index != None and delivery_queue_index == None:
-                # create one new task for delivery
-                for task in queue["tasks"][1:]: # all cost towards end of queue
-                    task_index = queue["tasks"].index(task)
-                    amr_cost += _distance(task.station.position, queue["tasks"][task_index-1].station.position) * DISTANCE_COST
-                    amr_cost += len(task.suborders) * TRANSFER_COST
-                # cost of last task to new delivery station
-                cost_dict[amr_id]["cost"] += _distance(queue["tasks"][-1].station.position, order.destination_station.position) * DISTANCE_COST
-            elif pickup_queue_index == None and delivery_queue_index == None:
+    def build_distance_matrix(self):
+        # Stations first, then parkings; only needs rebuilding when the layout changes (reset)
+        nodes = list(self.stations.values()) + list(self.parkings.values())
+        for index, node in enumerate(nodes):
+            node.index = index
+        self.node_positions = np.array([[node.position.x, node.position.y] for node in nodes], dtype=float)
+        delta = self.node_positions[:, None, :] - self.node_positions[None, :, :]
+        self.distance_matrix = np.hypot(delta[..., 0], delta[..., 1])
+        if self.roadmap is not None:
+            # travel goes dock leg -> shortest roadmap path -> dock leg, the same route plan_route() follows
+            self.node_docks = self.roadmap.nearest(self.node_positions)
+            dock_legs = np.hypot(*(self.node_positions - self.roadmap.points[self.node_docks]).T)
+            self.roadmap_node_distances = self.roadmap.distances[:, self.node_docks] + dock_legs[None, :]  # (roadmap nodes, nodes)
+            via_roadmap = dock_legs[:, None] + self.roadmap_node_distances[self.node_docks]
+            self.distance_matrix = np.where(self.distance_matrix <= 0.01, 0.0, via_roadmap)
+            if not np.isfinite(self.distance_matrix).all():
+                raise Exception("Roadmap does not connect every station and parking")
+
+    def amr_node_distances(self):
+        # (fleet size, nodes) distances from every AMR's current position in one vectorized pass
+        delta = self.amr_positions[:, None, :] - self.node_positions[None, :, :]
+        distances = np.hypot(delta[..., 0], delta[..., 1])
+        if self.roadmap is None:
+            return distances
+        nearest = self.roadmap.nearest(self.amr_positions)
+        legs = np.hypot(*(self.amr_positions - self.roadmap.points[nearest]).T)
+        return np.where(distances <= 0.01, 0.0, legs[:, None] + self.roadmap_node_distances[nearest])
+
+    def queue_tables(self, amr_id):
+        """Order-independent lookup tables of an AMR queue for the cost model, as a QueueCosts.
+
+        Only tasks from the first one changed since the last call are revisited, the prefix sums of
+        travel + transfer cost are extended from there; next_tasks() answers next-task queries.
+        """
+        costs = self.queue_costs[amr_id]
+        if costs.stale is None:
+            return costs
+        self.update_expected_states(self.amrs[amr_id])
+        tasks = self.amr_queues[amr_id]
+        start = min(costs.stale, len(tasks), len(costs.stations))
+        changed = tasks[start:]
+        for task in changed:
+            if not isinstance(task, Task):
+                raise Exception("Unexpected task type.")
+        stations = np.concatenate([costs.stations[:start], np.fromiter((task.station.index for task in changed), dtype=int, count=len(changed))])
+        # a task can take more suborders if it is not running yet (station slots of an executing task are already
+        # reserved) and has room for them, one more pickup if its expected load also leaves an AMR slot free
+        amr_capacity = self.config.amr_slot_capacity
+        suborder_limit = amr_capacity + self.config.station_slot_capacity - 2
+        open_tasks = np.concatenate([costs.open[:start], np.fromiter(
+            (task.status not in ["completed", "failed", "executing"] and len(task.suborders) <= suborder_limit for task in changed),
+            dtype=bool, count=len(changed))])
+        # the executor runs the tasks behind a sleeping delivery first, so its object stays on board meanwhile
+        asleep = np.concatenate([costs.asleep[:start], (costs.asleep[start-1] if start else 0) + np.cumsum(np.fromiter(
+            (sum(suborder.type == "delivery" for suborder in task.suborders) if task.status == "sleep" else 0 for task in changed),
+            dtype=int, count=len(changed)))])
+        loads = asleep + np.concatenate([costs.loads[:start] - costs.asleep[:start],
+                                         np.fromiter((len(state) for state in tasks.expected_states(start)), dtype=int, count=len(changed))])
+        eligible = open_tasks & (loads < amr_capacity-1)
+        legs = np.concatenate([costs.legs[:start], np.fromiter((len(task.suborders) for task in changed), dtype=float, count=len(changed))])
+        leg_start = max(start, 1)
+        if leg_start < len(tasks):
+            legs[leg_start:] = (self.distance_matrix[stations[leg_start-1:-1], stations[leg_start:]] * self.config.distance_cost
+                                + legs[leg_start:] * self.config.transfer_cost)
+        if len(legs):
+            legs[0] = 0.0
+        # prefix[i] = legs[1] + ... + legs[i-1], summed in the same order as a full rebuild
+        prefix = np.concatenate([costs.prefix[:start+1], np.cumsum(np.concatenate([costs.prefix[start:start+1], legs[start:]]))[1:]])
+        costs.stations, costs.open, costs.asleep, costs.loads, costs.eligible, costs.legs, costs.prefix = stations, open_tasks, asleep, loads, eligible, legs, prefix
+        costs.keys = np.sort(stations * (len(tasks) + 1) + np.arange(len(tasks)))
+        costs.pickup = np.full(len(self.stations), -1)
+        candidates = np.flatnonzero(eligible)
+        if len(candidates):
+            pickup_stations, first = np.unique(stations[candidates], return_index=True)
+            costs.pickup[pickup_stations] = candidates[first]
+        costs.stale = None
+        return costs
+
+    def next_tasks(self, costs:QueueCosts, task_indices, stations):
+        # first task index >= task_indices at stations, -1 if none, one binary search per query
+        if len(costs.keys) == 0:
+            return np.full(np.shape(stations), -1)
+        width = len(costs.stations) + 1
+        queries = stations * width + task_indices
+        keys = costs.keys[np.minimum(np.searchsorted(costs.keys, queries), len(costs.keys) - 1)]
+        return np.where((keys >= queries) & (keys // width == stations), keys % width, -1)
+
+    def assignment_cost_matrix(self, orders:list):
+        """(orders, fleet size) cost of serving each order with each AMR, with the queue indices it would use.
+
+        Pickup/delivery reuse the first matching queued task (pickup index -1 means a new pickup task is
+        appended, delivery index -1 a new delivery task). Cost is the travel + transfer cost of the AMR
+        queue up to the point the order is delivered. With cheapest_insertion the insertion_cost_matrix() is used instead.
+        """
+        if self.config.cheapest_insertion:
+            return self.insertion_cost_matrix(orders)
+        distance_cost = self.config.distance_cost
+        source = np.array([order.source_station.index for order in orders], dtype=int)
+        destination = np.array([order.destination_station.index for order in orders], dtype=int)
+        costs = np.zeros((len(orders), len(self.amrs)))
+        pickup_indices = np.full((len(orders), len(self.amrs)), -1)
+        delivery_indices = np.full((len(orders), len(self.amrs)), -1)
+        amr_distances = self.amr_node_distances()
+        for amr_id, amr in self.amrs.items():
+            tasks = self.amr_queues[amr_id]
+            column = amr.index
+            if len(tasks) == 0:
                 # create one new task for pickup and one new task for delivery
-                if len(queue["tasks"]) != 0:
-                    for i, task in enumerate(queue["tasks"][1:]): # all cost towards end of queue
-                        amr_cost += _distance(task.station.position, queue["tasks"][i-1].station.position) * DISTANCE_COST
-                        amr_cost += len(task.suborders) * TRANSFER_COST
-                    rp(queue["tasks"][-1].station, order.source_station)
-                    amr_cost += _distance(queue["tasks"][-1].station.position, order.source_station.position) * DISTANCE_COST
+                costs[:, column] = (amr_distances[column, source] + self.distance_matrix[source, destination]) * distance_cost
+                continue
+            self.update_expected_states(amr)
+            costs_table = self.queue_tables(amr_id)
+            prefix = costs_table.prefix
+            pickup_index = costs_table.pickup[source]
+            delivery_index = np.where(pickup_index >= 0, self.next_tasks(costs_table, np.maximum(pickup_index, 0), destination), -1)
+            last_station = tasks[-1].station.index
+            # add the first station distance cost
+            first_cost = amr_distances[column, tasks[0].station.index] * distance_cost + len(tasks[0].suborders) * self.config.transfer_cost
+            # no pickup task: all cost towards end of queue, then new pickup and delivery tasks
+            append_cost = prefix[-1] + (self.distance_matrix[last_station, source] + self.distance_matrix[source, destination]) * distance_cost
+            # pickup task but no delivery task: all cost towards end of queue, then new delivery task
+            pickup_only_cost = prefix[-1] + self.distance_matrix[last_station, destination] * distance_cost
+            # both suborders join existing tasks: cost up to the delivery task
+            grouped_cost = prefix[np.maximum(delivery_index, 0)]
+            costs[:, column] = first_cost + np.where(pickup_index < 0, append_cost, np.where(delivery_index < 0, pickup_only_cost, grouped_cost))
+            pickup_indices[:, column] = pickup_index
+            delivery_indices[:, column] = delivery_index
+        return costs, pickup_indices, delivery_indices
+
+    def insertion_cost_matrix(self, orders:list, amr_ids=None):
+        """(orders, fleet size) cost of the cheapest feasible insertion of each order into each AMR queue.
+
+        Cost is the finish cost of the AMR queue with the order inserted, as for appending in
+        assignment_cost_matrix(): the queue as it is plus the extra travel of the insertion. Positions are
+        queue ranks: 2*i+1 joins task i, 2*g inserts a new task before task g (2*len appends).
+        Every pickup position is paired with every delivery position after it in one (orders, ranks, ranks)
+        pass. The object holds an AMR slot from pickup to delivery, so every task in between must leave
+        the spare slot the executor keeps free: its load in queue_tables(), which counts the objects of
+        sleeping deliveries as still on board, stays under amr_slot_capacity - 1. A delivery to a station
+        projected_free_slots() leaves without room would sleep on the AMR until a pickup frees one. Such
+        an order is only taken if a delivery waits for the slot its own pickup frees, and then by an AMR
+        with a slot to spare besides the spare one, joining the last task or appended. The first task may
+        be running, so it is never preceded. Orders no AMR has room for, and AMRs left out of amr_ids,
+        keep an infinite cost.
+        """
+        distance_matrix = self.distance_matrix
+        station_count = len(self.stations)
+        source = np.array([order.source_station.index for order in orders], dtype=int)
+        destination = np.array([order.destination_station.index for order in orders], dtype=int)
+        direct = distance_matrix[source, destination]
+        costs = np.full((len(orders), len(self.amrs)), np.inf)
+        pickup_ranks = np.zeros((len(orders), len(self.amrs)), dtype=int)
+        delivery_ranks = np.zeros((len(orders), len(self.amrs)), dtype=int)
+        amr_distances = self.amr_node_distances()
+        spare_limit = self.config.amr_slot_capacity - 1
+        projected = self.projected_free_slots()
+        station_full = projected[destination] <= 0
+        # carried only if a delivery waits for the slot its pickup frees, otherwise it waits for room
+        unneeded = station_full & (projected[source] > 0)
+        for amr_id in self.amrs if amr_ids is None else amr_ids:
+            column = self.amrs[amr_id].index
+            task_count = len(self.amr_queues[amr_id])
+            if task_count == 0:
+                # ranks 0, 0: a new pickup task then a new delivery task
+                costs[:, column] = (amr_distances[column, source] + direct) * self.config.distance_cost
+                if len(self.amrs[amr_id].slots.held) >= spare_limit - 1:
+                    costs[station_full, column] = np.inf
+                continue
+            table = self.queue_tables(amr_id)
+            stations = table.stations
+            # travel + transfer cost of the queue as it is, from the AMR position to the end of the last task
+            finish = (amr_distances[column, stations[0]] * self.config.distance_cost
+                      + len(self.amr_queues[amr_id][0].suborders) * self.config.transfer_cost + table.prefix[-1])
+            ranks = 2 * task_count + 1
+            rank = np.arange(ranks)
+            index = rank // 2
+            is_gap = rank % 2 == 0
+            # detour[g-1, station]: extra travel of visiting station between task g-1 and task g, or after the last task
+            detour = distance_matrix[stations, :station_count].copy()
+            between = distance_matrix[stations[:-1], stations[1:]]
+            detour[:-1] += distance_matrix[stations[1:], :station_count] - between[:, None]
+            pickup_cost = np.full((len(orders), ranks), np.inf)
+            pickup_cost[:, 2::2] = detour[:, source].T
+            pickup_cost[:, 1::2] = np.where(table.open[None, :] & (table.loads[None, :] < spare_limit) & (stations[None, :] == source[:, None]), 0.0, np.inf)
+            delivery_cost = np.full((len(orders), ranks), np.inf)
+            delivery_cost[:, 2::2] = detour[:, destination].T
+            delivery_cost[:, 1::2] = np.where(table.open[None, :] & (stations[None, :] == destination[:, None]), 0.0, np.inf)
+            # an object for a full station rides to the end of the queue, on an AMR that keeps a slot besides the spare
+            delivery_cost[np.ix_(station_full, rank[:-2])] = np.inf
+            # both new tasks in the same gap: task g-1 -> source -> destination -> task g
+            same_gap = distance_matrix[stations][:, source].T + direct[:, None]
+            same_gap[:, :-1] += distance_matrix[destination][:, stations[1:]] - between[None, :]
+            # (pickup, delivery) ranks that keep the order and leave a free AMR slot on every task carrying the object
+            first_loaded = np.maximum(np.where(is_gap, index - 1, index), 0)
+            full = np.concatenate([[0], np.cumsum(table.loads >= spare_limit)])
+            feasible = (full[index][None, :] == full[first_loaded][:, None]) & (
+                (rank[None, :] > rank[:, None]) | (np.eye(ranks, dtype=bool) & is_gap[:, None]))
+            total = pickup_cost[:, :, None] + delivery_cost[:, None, :]
+            total[:, rank[2::2], rank[2::2]] = same_gap
+            total[:, ~feasible] = np.inf
+            # cheapest pair, on ties the fewest new tasks (a gap next to a task at the same station costs the same
+            # as joining it, but splits a pickup from the delivery it could swap with), then the earliest delivery
+            flat = total.transpose(0, 2, 1).reshape(len(orders), -1)
+            new_tasks = (is_gap[None, :].astype(int) + is_gap[:, None]).reshape(-1)
+            best = np.argmin(np.where(flat == flat.min(axis=1, keepdims=True), new_tasks[None, :], 3), axis=1)
+            costs[:, column] = finish + flat[np.arange(len(orders)), best] * self.config.distance_cost
+            delivery_ranks[:, column], pickup_ranks[:, column] = np.divmod(best, ranks)
+            if table.loads[-1] >= spare_limit - 1:
+                costs[station_full, column] = np.inf
+        costs[unneeded] = np.inf
+        return costs, pickup_ranks, delivery_ranks
+
+    def projected_free_slots(self):
+        # free slots of each station (by index) once every live order has run, the deliveries of orders
+        # waiting for an AMR are left out, their pickups are not unless the order is blocked itself
+        free = np.array([len(station.slots.free) for station in self.stations.values()])
+        for order in self.orders.values():
+            if order.status in ["completed", "failed"] or order.order_id in self.blocked_orders:
+                continue
+            pickup, delivery = order.suborders["pickup"], order.suborders["delivery"]
+            if pickup.status != "completed":
+                free[order.source_station.index] += 1
+            if delivery.task_id is not None and delivery.status != "completed":
+                free[order.destination_station.index] -= 1
+        return free
+
+    def commit_insertion(self, order:Order, amr_id, pickup_rank, delivery_rank):
+        # ranks as in insertion_cost_matrix(), the delivery is never ranked before the pickup
+        pickup_rank, delivery_rank = int(pickup_rank), int(delivery_rank)
+        logger.debug("order %s inserted into %s at pickup rank %s, delivery rank %s", order.order_id, amr_id, pickup_rank, delivery_rank)
+        order.assigned_amr = amr_id
+        tasks = self.amr_queues[amr_id]
+        placed = []
+        for suborder, rank, station in [(order.suborders["pickup"], pickup_rank, order.source_station),
+                                        (order.suborders["delivery"], delivery_rank, order.destination_station)]:
+            if rank % 2:
+                task = tasks[rank // 2]
             else:
-                rp("Invalid scenario in cost calculation, pickup index is None but delivery index is not.")
-        costs = {amr_id: cost_dict[amr_id]["cost"] for amr_id in cost_dict.keys()}
-        rp(costs)
+                self.task_counter += 1
+                task = Task(task_id=self.task_counter, assigned_amr=amr_id, station=station, time_stamp=self.clock)
+                self.add_task(task)
+            task.suborders.append(suborder)
+            suborder.task_id = task.id
+            placed.append((rank, task))
+        # the later position first, so the pickup rank still points at the same place
+        for rank, task in reversed(placed):
+            if rank % 2 == 0:
+                tasks.insert(rank // 2, task)
+        self.mark_expected_states_dirty(amr_id, pickup_rank // 2)
+        for rank, task in placed:
+            if rank % 2:
+                self.sort_alternating_suborders(task.id)
+        self.update_expected_states(self.amrs[amr_id])
+
+    def commit_order(self, order:Order, amr_id, pickup, delivery):
+        # pickup/delivery as returned by assignment_cost_matrix() for the active policy
+        if self.config.cheapest_insertion:
+            self.commit_insertion(order, amr_id, pickup, delivery)
+        else:
+            self.commit_assignment(order, amr_id, pickup, delivery)
+
+    def awaits_assignment(self, order:Order):
+        pickup = order.suborders["pickup"]
+        return order.status == "pending" and pickup.status == "pending" and pickup.task_id is None
+
+    def release_blocked_orders(self, station_id=None):
+        # blocked orders back into pending_orders, all of them or only those delivering to station_id
+        for order_id in sorted(self.blocked_orders):
+            order = self.orders.get(order_id)
+            if station_id is not None and order is not None and order.destination_station.id != station_id:
+                continue
+            self.blocked_orders.discard(order_id)
+            if order is not None and self.awaits_assignment(order):
+                heapq.heappush(self.pending_orders, (order.priority, order.created_at, order_id))
+
+    def rebuild_pending_orders(self):
+        self.pending_orders = [(order.priority, order.created_at, order_id) for order_id, order in self.orders.items() if self.awaits_assignment(order)]
+        heapq.heapify(self.pending_orders)
+
+    def pop_pending_orders(self, limit):
+        # Up to limit orders waiting for an AMR, most urgent first; entries of orders assigned or finished since are dropped
+        orders = []
+        while self.pending_orders and len(orders) < limit:
+            order = self.orders.get(heapq.heappop(self.pending_orders)[2])
+            if order is not None and self.awaits_assignment(order):
+                orders.append(order)
+        return orders
 
+    def cost_based_assignment(self, order:Order):
+        costs, pickup_indices, delivery_indices = self.assignment_cost_matrix([order])
+        amr_ids = list(self.amrs.keys())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Assignment costs of order %s: %s", order.order_id, {amr_id: float(costs[0, self.amrs[amr_id].index]) for amr_id in amr_ids})
+        best_amr_id = min(amr_ids, key=lambda amr_id: costs[0, self.amrs[amr_id].index])
+        column = self.amrs[best_amr_id].index
+        if not np.isfinite(costs[0, column]):
+            self.blocked_orders.add(order.order_id)
+            return
+        self.commit_order(order, best_amr_id, pickup_indices[0, column], delivery_indices[0, column])
+        self.update_expected_states(self.amrs[best_amr_id])
+
+    def batch_assignment(self, orders:list):
+        """Jointly assign a burst of orders by solving the orders x AMR-slots assignment problem.
+
+        Every AMR offers amr_slot_capacity slots per batch; the k-th slot of an AMR costs k extra
+        source-to-destination trips so orders spread over the fleet. Orders left without a slot are the
+        least urgent ones and stay pending for the next step, orders no AMR has room for wait in blocked_orders.
+        """
+        costs, _, _ = self.assignment_cost_matrix(orders)
+        placeable = np.isfinite(costs).any(axis=1)
+        self.blocked_orders.update(order.order_id for order, ok in zip(orders, placeable) if not ok)
+        orders = [order for order, ok in zip(orders, placeable) if ok]
+        if not orders:
+            return
+        costs = costs[placeable]
+        trips = self.distance_matrix[[order.source_station.index for order in orders], [order.destination_station.index for order in orders]] * self.config.distance_cost
+        slot_costs = np.concatenate([costs + k * trips[:, None] for k in range(self.config.amr_slot_capacity)], axis=1)
+        if len(orders) > slot_costs.shape[1]:
+            # every priority level outweighs any difference in cost of the assigned orders
+            levels = np.unique([order.priority for order in orders], return_inverse=True)[1].reshape(-1)
+            if levels.any():
+                finite = slot_costs[np.isfinite(slot_costs)]
+                slot_costs = slot_costs + levels[:, None] * (slot_costs.shape[1] * (np.ptp(finite) + 1))
+        # an AMR without room for an order costs more than any complete assignment, so the problem stays solvable
+        infeasible = ~np.isfinite(slot_costs)
+        slot_costs[infeasible] = np.abs(slot_costs[~infeasible]).sum() + 1
+        rows, columns = linear_sum_assignment(slot_costs)
+        amr_ids = {amr.index: amr_id for amr_id, amr in self.amrs.items()}
+        for row, column in sorted(zip(rows, columns)):
+            if infeasible[row, column]:
+                continue # the AMRs with room went to other orders, tried again next step
+            order = orders[row]
+            amr_id = amr_ids[column % len(self.amrs)]
+            # queues changed while committing earlier orders of the batch, so recompute the reused tasks
+            indices = self.assignment_indices(order, amr_id)
+            if indices is None:
+                continue # earlier orders of the batch took the room
+            self.commit_order(order, amr_id, *indices)
+            self.update_expected_states(self.amrs[amr_id])
+
+    def assignment_indices(self, order:Order, amr_id):
+        # None if the AMR has no room for the order
+        if self.config.cheapest_insertion:
+            costs, pickup_ranks, delivery_ranks = self.insertion_cost_matrix([order], [amr_id])
+            column = self.amrs[amr_id].index
+            if not np.isfinite(costs[0, column]):
+                return None
+            return pickup_ranks[0, column], delivery_ranks[0, column]
+        if len(self.amr_queues[amr_id]) == 0:
+            return -1, -1
+        self.update_expected_states(self.amrs[amr_id])
+        costs = self.queue_tables(amr_id)
+        pickup_index = costs.pickup[order.source_station.index]
+        if pickup_index < 0:
+            return -1, -1
+        return pickup_index, self.next_tasks(costs, pickup_index, order.destination_station.index)
+
+    def commit_assignment(self, order:Order, best_amr_id, pickup_queue_index, delivery_queue_index):
+        pickup_queue_index = None if pickup_queue_index < 0 else int(pickup_queue_index)
+        delivery_queue_index = None if delivery_queue_index < 0 else int(delivery_queue_index)
+        if pickup_queue_index != None:
+            logger.debug("pickup suborder of order %s can be assigned to queue%s of %s", order.order_id, pickup_queue_index, best_amr_id)
+        if delivery_queue_index != None:
+            logger.debug("delivery suborder of order %s can be assigned to queue%s of %s", order.order_id, delivery_queue_index, best_amr_id)
         # Actual assigning and expected states
-        best_amr_id = min(cost_dict, key=lambda amr_id: cost_dict[amr_id]["cost"])
         order.assigned_amr = best_amr_id
-        pickup_queue_index = cost_dict[best_amr_id]["pickup_index"]
-        delivery_queue_index = cost_dict[best_amr_id]["delivery_index"]
         queue = self.amr_queues[best_amr_id]
         source_station_id = order.source_station.id
         destination_station_id = order.destination_station.id
-        expected_states = queue["expected_states"]
 
         if pickup_queue_index != None:
-            pickup_task_id = queue["tasks"][pickup_queue_index].id
+            pickup_task_id = queue[pickup_queue_index].id
             order.suborders["pickup"].task_id = pickup_task_id
             self.tasks[pickup_task_id].suborders.append(order.suborders["pickup"])
             self.sort_alternating_suborders(pickup_task_id)
-            self.update_expected_states(self.amrs[best_amr_id])
         else:
             self.task_counter += 1
-            pickup_task_id = str(self.task_counter)
-            self.tasks[pickup_task_id] = Task(task_id=pickup_task_id, assigned_amr=best_amr_id, station=self.stations[source_station_id])
+            pickup_task_id = self.task_counter
+            self.add_task(Task(task_id=pickup_task_id, assigned_amr=best_amr_id, station=self.stations[source_station_id], time_stamp=self.clock))
             self.suborders[order.suborders["pickup"].suborder_id].task_id = pickup_task_id
             order.suborders["pickup"] = self.suborders[order.suborders["pickup"].suborder_id]
             self.tasks[pickup_task_id].suborders.append(order.suborders["pickup"])
-            queue["tasks"].append(self.tasks[pickup_task_id])
-            pickup_queue_index = len(queue["tasks"])-1
-
-            # Assuming add task to end of queue, modify for expected states if insert prioritized task within queue
-            expected_states.append(set() if len(expected_states)==0 else copy.copy(expected_states[-1]))
+            queue.append(self.tasks[pickup_task_id])
+            pickup_queue_index = len(queue)-1
 
         if delivery_queue_index != None:
-            delivery_task_id = queue["tasks"][cost_dict[best_amr_id]["delivery_index"]].id
+            delivery_task_id = queue[delivery_queue_index].id
             self.tasks[delivery_task_id].suborders.append(order.suborders["delivery"])
             self.suborders[order.suborders["delivery"].suborder_id].task_id = delivery_task_id
             self.sort_alternating_suborders(pickup_task_id)
-            self.update_expected_states(self.amrs[best_amr_id])
         else:
             self.task_counter += 1
-            delivery_task_id = str(self.task_counter)
-            self.tasks[delivery_task_id] = Task(task_id=delivery_task_id, assigned_amr=best_amr_id, station=self.stations[destination_station_id])
+            delivery_task_id = self.task_counter
+            self.add_task(Task(task_id=delivery_task_id, assigned_amr=best_amr_id, station=self.stations[destination_station_id], time_stamp=self.clock))
             self.suborders[order.suborders["delivery"].suborder_id].task_id = delivery_task_id
             order.suborders["delivery"] = self.suborders[order.suborders["delivery"].suborder_id]
             self.tasks[delivery_task_id].suborders.append(order.suborders["delivery"])
-            queue["tasks"].append(self.tasks[delivery_task_id])
-            delivery_queue_index = len(queue["tasks"])-1
-
-            # Assuming add task to end of queue, modify for expected states if insert prioritized task within queue
-            expected_states.append(copy.copy(expected_states[-1])) # also append for delivery states
+            queue.append(self.tasks[delivery_task_id])
 
-        for state in expected_states[pickup_queue_index:delivery_queue_index]:
-            state.add(order.object_id)
+        # the object is carried from the pickup task until the delivery task
+        self.mark_expected_states_dirty(best_amr_id, pickup_queue_index)
+        self.update_expected_states(self.amrs[best_amr_id])
 
     def amr_slot_reservation(self, amr: AMR):
         pickup_suborders = len([s for s in amr.task.suborders if s.type == "pickup" and s.status == "pending"])
         delivery_suborders = len([s for s in amr.task.suborders if s.type == "delivery" and s.status == "pending"])
-        available_slots = len([slot for slot in amr.slots.values() if slot["object_id"] is None])
+        available_slots = len(amr.slots.free)
         required_slots = max(0, pickup_suborders - delivery_suborders)
-        rp(f"{amr.id} has {available_slots} available_slots, pickup suborders: {pickup_suborders}, delivery suborders: {delivery_suborders}, required reservations: {required_slots}")
+        logger.debug("%s has %s available_slots, pickup suborders: %s, delivery suborders: %s, required reservations: %s",
+                     amr.id, available_slots, pickup_suborders, delivery_suborders, required_slots)
 
         if available_slots < required_slots:
             raise Exception("Not enough available slots for pickup and delivery suborders of current task.")
@@ -466,8 +1058,8 @@ class MedibotSystem:
         station = self.stations[amr.task.station.id]
         suborders = [s for s in amr.task.suborders if s.status == "pending"]
 
-        station_real_available_slots = len([slot_id for slot_id, slot in station.slots.items() if slot["object_id"] is None])
-        amr_real_available_slots = len([slot_id for slot_id, slot in amr.slots.items() if slot["object_id"] is None])-1
+        station_real_available_slots = len(station.slots.free)
+        amr_real_available_slots = len(amr.slots.free)-1
         pickup_suborders = [s for s in suborders if s.type == "pickup"]
         delivery_suborders = [s for s in suborders if s.type == "delivery"]
         station_required_slots = max(0, len(delivery_suborders) - len(pickup_suborders))
@@ -478,43 +1070,36 @@ class MedibotSystem:
 
         if amr_real_available_slots < amr_required_slots:
             raise Exception("Not enough effective amr slots for pickup suborders in task.")
-        real_available_slots = [
-            slot_id for slot_id, slot in station.slots.items()
-            if slot["object_id"] is None and (not slot.get("reservation") or len(slot["reservation"]) == 0)
-        ]
+        real_available_slots = [slot for slot in station.slots.free if len(station.slots.reservations[slot]) == 0]
         available_slot_queue = real_available_slots.copy()
         for suborder in suborders:
             if suborder.type == "pickup":
                 # Reserve the slot where the object is
-                for slot_id, slot in station.slots.items():
-                    if slot["object_id"] != suborder.object_id:
-                        continue
-                    if suborder.order_id not in slot["reservation"]:
-                        slot["reservation"].append(suborder.order_id)
-                        rp(f"{amr.id} reserved {station.id} {slot_id} for order {suborder.order_id} (pickup)")
-                    available_slot_queue.append(slot_id)  # Now reusable
-                    break
+                slot = self.find_object_in_slots(station, suborder.object_id)
+                if slot is not None:
+                    if self.reserve_slot(station, slot, suborder.order_id):
+                        logger.debug("%s reserved %s slot_%s for order %s (pickup)", amr.id, station.id, slot, suborder.order_id)
+                    available_slot_queue.append(slot)  # Now reusable
 
             elif suborder.type == "delivery":
-                slot_id = available_slot_queue.pop(0)
-                slot = station.slots[slot_id]
-                if suborder.order_id not in slot["reservation"]:
-                    slot["reservation"].append(suborder.order_id)
-                    rp(f"{amr.id} reserved {station.id} {slot_id} for order {suborder.order_id} (delivery)")
+                slot = available_slot_queue.pop(0)
+                if self.reserve_slot(station, slot, suborder.order_id):
+                    logger.debug("%s reserved %s slot_%s for order %s (delivery)", amr.id, station.id, slot, suborder.order_id)
 
     def amr_state_validation(self, amr:AMR):
-        actual_objects = {slot["object_id"] for slot in amr.slots.values() if slot["object_id"] is not None}
-        actual_nones = sum(1 for slot in amr.slots.values() if slot["object_id"] is None)
-        expected_objects = self.amr_queues[amr.id]["expected_states"][0]
-        expected_nones = AMR_SLOT_CAPACITY - len(expected_objects)
+        actual_objects = amr.slots.held
+        actual_nones = len(amr.slots.free)
+        self.update_expected_states(amr)
+        expected_objects = self.amr_queues[amr.id].state(0)
+        expected_nones = len(amr.slots) - len(expected_objects)
         if actual_objects != expected_objects:
             raise Exception(f"Object mismatch. Expected: {expected_objects}, Got: {actual_objects}")
         if actual_nones != expected_nones:
             raise Exception(f"Empty slot mismatch. Expected {expected_nones} empty slots, got {actual_nones}")
-        print("AMR state is valid: Correct objects and correct number of empty slots.")
+        logger.debug("%s state is valid: Correct objects and correct number of empty slots.", amr.id)
 
     def pre_task_validation(self, amr:AMR, task:Task):
-        # rp(f"Validating task {task.id} for {amr.id}")
+        # logger.debug(f"Validating task {task.id} for {amr.id}")
         has_valid_suborder = False
         queue = self.amr_queues[amr.id]
         suborders = task.suborders
@@ -524,61 +1109,82 @@ class MedibotSystem:
         if not isinstance(station, Station):
             raise Exception("Unexpected station type.")
         if station.status != "idle":
-            print(f"Station is not idle")
+            logger.debug("Station %s is not idle", station.id)
             return
 
-        station_real_available_slots = len([slot_id for slot_id, slot in station.slots.items() if slot["object_id"] is None])
-        amr_real_available_slots = len([slot_id for slot_id, slot in amr.slots.items() if slot["object_id"] is None])-1
-        station_objects = {slot["object_id"] for slot in station.slots.values() if slot["object_id"] is not None}
-        amr_objects = {slot["object_id"] for slot in amr.slots.values() if slot["object_id"] is not None}
+        station_real_available_slots = len(station.slots.free)
+        amr_real_available_slots = len(amr.slots.free)-1
+        station_objects = station.slots.held
+        amr_objects = amr.slots.held
         
         pickup_suborders = [s for s in suborders if s.type == "pickup"]
         delivery_suborders = [s for s in suborders if s.type == "delivery"]
-        station_required_slots = max(0, len(delivery_suborders) - len(pickup_suborders))
-        amr_required_slots = max(0, len(pickup_suborders) - len(delivery_suborders))
         invalid_pickup_suborders = {s for s in pickup_suborders if s.object_id not in station_objects}
         invalid_delivery_suborders = set()
 
         for suborder in delivery_suborders:
             order = self.orders[suborder.order_id]
-            pickup_id = order.suborders["pickup"].task_id            
-            pickup_task_of_this_delivery = self.tasks_history[pickup_id] if pickup_id in self.tasks_history.keys() else None
-            if pickup_task_of_this_delivery:
-                if pickup_task_of_this_delivery.status == "completed" and suborder.object_id in amr_objects:
-                    continue # delivery is valid 
-                elif pickup_task_of_this_delivery.status in ["failed", "cancelled"]:
-                    rp(f"Pickup order of {suborder.object_id} was {pickup_task_of_this_delivery.status} previously, invalidating delivery")
-                elif pickup_task_of_this_delivery.status == "completed" and suborder.object_id not in amr_objects:
-                    rp(f"Pickup order of {suborder.object_id} was completed previously, but object not in {amr.id}, invalidating delivery")
+            pickup_id = order.suborders["pickup"].task_id
+            if pickup_id in self.tasks:
+                continue # pickup task still queued or running, delivery is valid
+            # the pickup task is retired, its suborder tells how it ended without reading the history back from its store
+            pickup = order.suborders["pickup"]
+            if pickup.status in ["completed", "failed"]:
+                if pickup.status == "completed" and suborder.object_id in amr_objects:
+                    continue # delivery is valid
+                elif pickup.status == "failed":
+                    logger.warning("Pickup order of %s was %s previously, invalidating delivery", suborder.object_id, pickup.status)
                 else:
-                    rp(f"Undefined condition invalidated delivery")
+                    logger.warning("Pickup order of %s was completed previously, but object not in %s, invalidating delivery", suborder.object_id, amr.id)
                 invalid_delivery_suborders.add(suborder)
                 continue
+            logger.warning("Pickup task of object %s not found in queue and history, invalidating delivery", suborder.object_id)
+            invalid_delivery_suborders.add(suborder)
             
-            pickup_task_of_this_delivery = self.tasks[pickup_id] if pickup_id in self.tasks.keys() else None
-            if pickup_task_of_this_delivery:
-                # rp(f"Found pickup task of {suborder.object_id} delivery in queue, delivery is valid")
-                continue
-            else:
-                rp(f"Pickup task of object {suborder.object_id} not found in queue and history, invalidating delivery")
-                print("SO WEIRD!!!!")
-                invalid_delivery_suborders.add(suborder)
-            
+        # failed suborders fail their order in step(), the rest of the task carries on
         for invalid_pickup in invalid_pickup_suborders:
-            invalid_pickup.status = "failed"
-            print(f"Cant pickup object {invalid_pickup.object_id} from station {station.id}") if task.status == "queued" else None
-            input()
+            self.set_suborder_status(invalid_pickup, "failed")
+            logger.warning("Cant pickup object %s from station %s", invalid_pickup.object_id, station.id) if task.status == "queued" else None
         for invalid_delivery in invalid_delivery_suborders:
-            invalid_delivery.status = "failed"
-            print(f"Cant deliver object {invalid_delivery.object_id} to station {station.id}") if task.status == "queued" else None
-            input()
+            self.set_suborder_status(invalid_delivery, "failed")
+            logger.warning("Cant deliver object %s to station %s", invalid_delivery.object_id, station.id) if task.status == "queued" else None
 
-        suborders = list(set(suborders) - invalid_pickup_suborders - invalid_delivery_suborders)
+        # keep queue order so runs are reproducible (set iteration order depends on object ids)
+        suborders = [s for s in suborders if s not in invalid_pickup_suborders and s not in invalid_delivery_suborders]
         if len(suborders) == 0:
+            self.drop_task(amr, task)
             return has_valid_suborder
 
         pickup_suborders = [s for s in suborders if s.type == "pickup"]
         delivery_suborders = [s for s in suborders if s.type == "delivery"]
+        # a full station is freed by a swap: pickups waiting there further down the queue join this task, one per
+        # delivery without a free slot, and the AMR takes each object into its spare slot before leaving one
+        shortfall = len(delivery_suborders) - len(pickup_suborders) - station_real_available_slots
+        position = queue.position(task)
+        if shortfall > 0 and position is not None:
+            for other_task in queue[position+1:]:
+                if shortfall == 0:
+                    break
+                if other_task.station is not station or other_task.status not in ["queued", "sleep"]:
+                    continue
+                pulled = [s for s in other_task.suborders if s.type == "pickup" and s.status == "pending" and s.object_id in station_objects][:shortfall]
+                if not pulled:
+                    continue
+                shortfall -= len(pulled)
+                for suborder in pulled:
+                    suborder.task_id = task.id
+                suborders += pulled
+                original_suborders += pulled
+                remaining = [s for s in other_task.suborders if s not in pulled]
+                if remaining:
+                    self.set_task_suborders(other_task, remaining)
+                else:
+                    self.mark_expected_states_dirty(amr.id, queue.remove(other_task))
+                    self.retire_task(other_task) # its pickups joined this task
+            pickup_suborders = [s for s in suborders if s.type == "pickup"]
+        # required slots of the suborders that can still run, an invalid delivery no longer frees an AMR slot
+        station_required_slots = max(0, len(delivery_suborders) - len(pickup_suborders))
+        amr_required_slots = max(0, len(pickup_suborders) - len(delivery_suborders))
 
         delayed_pickup = []
         delayed_delivery = []
@@ -591,276 +1197,517 @@ class MedibotSystem:
                 delayed_delivery = delivery_suborders[:n_delivery_to_remove]
                 delivery_suborders = delivery_suborders[n_delivery_to_remove:]
         if amr_real_available_slots < amr_required_slots:
-            n_pickup_to_remove = amr_required_slots - amr_real_available_slots
-            delayed_pickup = pickup_suborders[-n_pickup_to_remove:].copy()
-            pickup_suborders = pickup_suborders[:n_pickup_to_remove]
+            n_pickup_to_remove = min(amr_required_slots - amr_real_available_slots, len(pickup_suborders))
+            delayed_pickup = pickup_suborders[len(pickup_suborders)-n_pickup_to_remove:].copy()
+            pickup_suborders = pickup_suborders[:len(pickup_suborders)-n_pickup_to_remove]
 
         if len(pickup_suborders) + len(delivery_suborders) != 0:
             has_valid_suborder = True
         if set(delayed_pickup) | set(delayed_delivery) == set(original_suborders):
             has_valid_suborder = False
-            task.status = "sleep"
-            task.suborders = delayed_pickup + delayed_delivery
+            self.set_task_status(task, "sleep")
+            self.set_task_suborders(task, delayed_pickup + delayed_delivery)
             self.update_expected_states(amr)
             return has_valid_suborder
-        print(f"Task {task.id} has {'no ' if not has_valid_suborder else ''}valid suborders") if task.status != "sleep" else None
+        logger.debug("Task %s has %svalid suborders", task.id, "" if has_valid_suborder else "no ") if task.status != "sleep" else None
 
         if delayed_pickup:
+            # the delayed pickups sleep in their own task right after this one, still ahead of their deliveries
+            self.task_counter += 1
+            pickup_task = Task(task_id=self.task_counter, assigned_amr=amr.id, station=station, time_stamp=self.clock)
+            pickup_task.suborders.extend(delayed_pickup)
+            self.add_task(pickup_task)
+            self.set_task_status(pickup_task, "sleep")
+            position = queue.position(task) + 1
+            queue.insert(position, pickup_task)
+            self.mark_expected_states_dirty(amr.id, position)
+            for suborder in delayed_pickup:
+                suborder.task_id = pickup_task.id
             for suborder in delayed_pickup:
-                print(f"Delayed {suborder.object_id} pickup from station {suborder.station_id}") if task.status != "sleep" else None
+                logger.debug("Delayed %s pickup from station %s", suborder.object_id, suborder.station_id) if task.status != "sleep" else None
                 order = self.orders[suborder.order_id]
                 delivery_suborder = order.suborders["delivery"]
                 original_delivery_task = self.tasks[order.suborders["delivery"].task_id]
                 
                 if len(original_delivery_task.suborders) == 1:
-                    rp(f"putting delivery task {task.id} to sleep") if task.status != "sleep" else None
-                    original_delivery_task.status = "sleep"
+                    logger.debug("putting delivery task %s to sleep", original_delivery_task.id) if task.status != "sleep" else None
+                    self.set_task_status(original_delivery_task, "sleep")
                 else:
                     # create new task and let the grouper do its job
                     self.task_counter += 1
-                    new_delivery_task_id = str(self.task_counter)
-                    new_delivery_task = Task(task_id=new_delivery_task_id, assigned_amr=amr.id, station=original_delivery_task.station)
+                    new_delivery_task_id = self.task_counter
+                    new_delivery_task = Task(task_id=new_delivery_task_id, assigned_amr=amr.id, station=original_delivery_task.station, time_stamp=self.clock)
                     new_delivery_task.suborders.append(delivery_suborder)
-                    original_delivery_task.suborders.remove(suborder)
-                    self.tasks[new_delivery_task_id] = new_delivery_task
-                    queue["tasks"].append(new_delivery_task)
+                    self.mark_task_dirty(original_delivery_task)
+                    original_delivery_task.suborders.remove(delivery_suborder)
+                    self.add_task(new_delivery_task)
+                    queue.append(new_delivery_task)
+                    self.mark_expected_states_dirty(amr.id, len(queue)-1)
                     delivery_suborder.task_id = new_delivery_task_id
                     self.update_expected_states(amr)
 
         if delayed_delivery:
             for suborder in delayed_delivery:
-                print(f"Delayed {suborder.object_id} delivery to station {suborder.station_id}") if task.status != "sleep" else None
+                logger.debug("Delayed %s delivery to station %s", suborder.object_id, suborder.station_id) if task.status != "sleep" else None
                 is_reassigned = False
-                for other_task in queue["tasks"][1:]: # check from next task onwards
+                for other_task in queue[1:]: # check from next task onwards
                     if other_task.status not in ["sleep", "queued"]:
                         continue
                     if other_task.station.id != suborder.station_id:
                         continue
                     other_task.suborders.append(suborder)
                     is_reassigned = True
-                    rp(f"Reassigned {suborder.object_id} delivery to task {other_task.id}")
+                    logger.debug("Reassigned %s delivery to task %s", suborder.object_id, other_task.id)
                     task.suborders.remove(suborder)
+                    self.mark_task_dirty(task)
+                    self.mark_task_dirty(other_task)
                     self.update_expected_states(amr)
                     break
                 if is_reassigned:
                     continue
                 self.task_counter += 1
-                new_task_id = str(self.task_counter)
-                self.tasks[new_task_id] = Task(task_id=new_task_id, assigned_amr=amr.id, station=self.stations[suborder.station_id])
+                new_task_id = self.task_counter
+                self.add_task(Task(task_id=new_task_id, assigned_amr=amr.id, station=self.stations[suborder.station_id], time_stamp=self.clock))
                 new_task = self.tasks[new_task_id]
                 new_task.suborders.append(suborder)
-                queue["tasks"].append(new_task)
-                queue["expected_states"].append(set() if len(queue["expected_states"])==0 else copy.copy(queue["expected_states"][-1]))
+                queue.append(new_task)
+                self.mark_expected_states_dirty(amr.id, len(queue)-1)
                 suborder.task_id = new_task_id
                 self.update_expected_states(amr)
         
         if set(delayed_pickup) | set(delayed_delivery) == set(original_suborders):
             has_valid_suborder = False
-            task.status = "sleep"
-            task.suborders = delayed_pickup + delayed_delivery
+            self.set_task_status(task, "sleep")
+            self.set_task_suborders(task, delayed_pickup + delayed_delivery)
             return has_valid_suborder
 
-        task.suborders = pickup_suborders + delivery_suborders
+        self.set_task_suborders(task, pickup_suborders + delivery_suborders)
         if len(task.suborders) != 0:
-            task.status = "queued"
+            self.set_task_status(task, "queued")
             has_valid_suborder = True
-        self.update_expected_states(amr) if any(delayed_pickup) or any(delayed_delivery) else None
+        self.update_expected_states(amr)
         return has_valid_suborder
 
-    def update_expected_states(self, amr:AMR):
+    def defer_deliveries(self, amr:AMR, task:Task, deliveries:list):
+        # moves deliveries out of task into a new task at the end of the queue
         queue = self.amr_queues[amr.id]
-        amr_current_objects = {slot["object_id"] for slot in amr.slots.values() if slot["object_id"] is not None}
-        for task_index, task in enumerate(queue["tasks"]):
-            expected_states = queue["expected_states"]
-            expected_states[task_index] = amr_current_objects.copy() if task_index == 0 else expected_states[task_index-1].copy()
-            pickup_objects = {suborder.object_id for suborder in task.suborders if suborder.type == "pickup"}
-            delivery_objects = {suborder.object_id for suborder in task.suborders if suborder.type == "delivery"}
-            expected_states[task_index] = expected_states[task_index].union(pickup_objects)
-            expected_states[task_index] = expected_states[task_index].difference(delivery_objects)
+        self.task_counter += 1
+        new_task = Task(task_id=self.task_counter, assigned_amr=amr.id, station=task.station, time_stamp=self.clock)
+        new_task.suborders.extend(deliveries)
+        self.add_task(new_task)
+        queue.append(new_task)
+        for suborder in deliveries:
+            suborder.task_id = new_task.id
+        self.set_task_suborders(task, [suborder for suborder in task.suborders if suborder not in deliveries])
+        self.mark_expected_states_dirty(amr.id, len(queue)-1)
+        self.update_expected_states(amr)
+
+    def fail_station_pickups(self, amr:AMR, task:Task):
+        # the station stayed busy past config.station_wait_timeout (e.g. an AMR failed there), fail the pickups waiting on it
+        # so their orders end and pre_task_validation drops the deliveries instead of holding the queue forever
+        pickups = [suborder for suborder in task.suborders if suborder.type == "pickup"]
+        if not pickups:
+            return
+        logger.warning("Station %s busy since tick %s, failing %s pickups of task %s", task.station.id, task.station.busy_since, len(pickups), task.id)
+        for suborder in pickups:
+            self.set_suborder_status(suborder, "failed")
+        suborders = [suborder for suborder in task.suborders if suborder.type != "pickup"]
+        if not suborders:
+            self.drop_task(amr, task)
+            return
+        self.set_task_suborders(task, suborders)
+        self.update_expected_states(amr)
+
+    def drop_task(self, amr:AMR, task:Task):
+        # every suborder of the task failed, retire it instead of revalidating it each step
+        task_index = self.amr_queues[amr.id].remove(task)
+        self.mark_expected_states_dirty(amr.id, task_index)
+        self.set_task_status(task, "failed")
+        self.retire_task(task)
+        logger.warning("Task %s of %s dropped, all suborders failed", task.id, amr.id)
+
+    def add_task(self, task:Task):
+        # Live tasks enter and leave self.tasks and change status only through add_task/set_task_status/retire_task,
+        # which keep amr_task_counts and completed_tasks current
+        self.state_changed_at = self.clock
+        self.tasks[task.id] = task
+        self.amr_task_counts[task.assigned_amr][task.status] += 1
+
+    def set_task_status(self, task:Task, status):
+        if status != task.status:
+            self.state_changed_at = self.clock
+            position = self.amr_queues[task.assigned_amr].position(task)
+            if position is not None:
+                self.mark_queue_costs_stale(task.assigned_amr, position) # open and asleep depend on the status
+        if task.id in self.tasks:
+            counts = self.amr_task_counts[task.assigned_amr]
+            counts[task.status] -= 1
+            counts[status] += 1
+            if status == "completed":
+                self.completed_tasks.add(task.id)
+        task.status = status
+
+    def retire_task(self, task:Task):
+        self.state_changed_at = self.clock
+        if self.tasks.pop(task.id, None) is not None:
+            self.amr_task_counts[task.assigned_amr][task.status] -= 1
+            self.completed_tasks.discard(task.id)
+        self.tasks_history[task.id] = task
+
+    def set_suborder_status(self, suborder:SubOrder, status):
+        if status != suborder.status:
+            self.state_changed_at = self.clock
+        suborder.status = status
+        if status in ["completed", "failed"]:
+            self.changed_orders.add(suborder.order_id)  # step() checks whether the order is finished
+
+    def set_order_status(self, order:Order, status):
+        self.order_counts[order.status] -= 1
+        self.order_counts[status] += 1
+        order.status = status
+
+    def order_outcome(self, order:Order):
+        # status a pending order moves to, None while it is still in progress
+        if all([suborder.status=="completed" for suborder in order.suborders.values()]):
+            return "completed"
+        if any([suborder.status=="failed" for suborder in order.suborders.values()]):
+            return "failed"
+        return None
+
+    def rebuild_status_indexes(self):
+        self.amr_task_counts = {amr_id: collections.Counter() for amr_id in self.amrs}
+        for task in self.tasks.values():
+            self.amr_task_counts[task.assigned_amr][task.status] += 1
+        self.completed_tasks = {task_id for task_id, task in self.tasks.items() if task.status == "completed"}
+        self.order_counts = collections.Counter(order.status for order in self.orders.values())
+        self.changed_orders = set(self.orders)
+
+    def mark_expected_states_dirty(self, amr_id, task_index=0):
+        # Every change to a queue's tasks or their suborders must report the first index it touched
+        self.state_changed_at = self.clock
+        self.amr_queues[amr_id].mark_dirty(task_index)
+        self.mark_queue_costs_stale(amr_id, task_index)
+
+    def mark_queue_costs_stale(self, amr_id, task_index=0):
+        # also needed on its own for changes that keep expected states valid but move or restatus tasks
+        costs = self.queue_costs[amr_id]
+        if costs.stale is None or task_index < costs.stale:
+            costs.stale = task_index
+
+    def mark_task_dirty(self, task:Task):
+        task_index = self.amr_queues[task.assigned_amr].position(task)
+        if task_index is None:
+            return # not queued, no expected state
+        self.mark_expected_states_dirty(task.assigned_amr, task_index)
+
+    def set_task_suborders(self, task:Task, suborders:list):
+        if suborders == task.suborders:
+            return
+        self.mark_task_dirty(task)
+        task.suborders = suborders
+
+    def update_expected_states(self, amr:AMR):
+        # Recompute only from the first dirty task onward, repeated calls without changes are free
+        self.amr_queues[amr.id].refresh(amr.slots.held)
 
     def order_validation(self):
         pass
 
     def wake_task(self, amr:AMR):
         # check all task validity, wake sleep tasks if possible
-        for task in self.amr_queues[amr.id]["tasks"]:
+        for task in list(self.amr_queues[amr.id]): # validation may drop tasks
             if not isinstance(task, Task):
                 raise Exception("Unexpected task type.")
             if task.status != "sleep":
                 continue
             has_valid_suborder = self.pre_task_validation(self.amrs[amr.id], task)
             if has_valid_suborder:
-                task.status = "queued"
+                self.set_task_status(task, "queued")
                 return # wake one per step
+        self.sleep_checked_at[amr.id] = self.clock # still asleep, the event engine skips ticks until state_changed_at moves
 
     def task_assignment(self, amr:AMR):
-        if len(self.amr_queues[amr.id]["tasks"]) == 0:
+        if len(self.amr_queues[amr.id]) == 0:
             return
         assigned_task_index = None
-        for task in self.amr_queues[amr.id]["tasks"]:
+        has_valid_suborder = False
+        held_orders = set() # orders whose pickup is in a task that cannot run yet, their deliveries wait for it
+        for task in list(self.amr_queues[amr.id]): # validation may drop tasks
             if not isinstance(task, Task):
                 raise Exception("Unexpected task type.")
+            pickups = [suborder for suborder in task.suborders if suborder.type == "pickup"]
+            if task.station.status != "idle" and task.status != "sleep":
+                if self.clock - task.station.busy_since >= self.config.station_wait_timeout:
+                    self.fail_station_pickups(amr, task)
+                    continue
+                logger.debug("%s waiting for %s to be idle", amr.id, task.station.id)
+                held_orders.update(suborder.order_id for suborder in pickups)
+                continue
+            held = [suborder for suborder in task.suborders if suborder.type == "delivery" and suborder.order_id in held_orders]
+            if len(held) == len(task.suborders):
+                continue # running it now would arrive without the objects
+            if held:
+                # the rest of the task can run, the held deliveries move behind their pickups
+                self.defer_deliveries(amr, task, held)
             has_valid_suborder = self.pre_task_validation(self.amrs[amr.id], task)
             if not has_valid_suborder:
+                # asleep, delayed or dropped: whichever of its pickups did not fail still has to run first
+                held_orders.update(suborder.order_id for suborder in pickups if suborder.status != "failed")
                 continue
-            assigned_task_index = self.amr_queues[amr.id]["tasks"].index(task)
+            assigned_task_index = self.amr_queues[amr.id].position(task)
             task.station.status = "busy"
+            task.station.busy_since = self.clock
             self.sort_alternating_suborders(task.id)
             self.update_expected_states(amr)
             amr.status = "busy"
             amr.task = task
             amr.task_id = task.id
-            amr.goal_timestamp = time.time()
-            amr.goal = task.station.position
-            task.status = "executing"
+            self.set_goal(amr, task.station, self.timestamp())
+            self.set_task_status(task, "executing")
+            self.mark_queue_costs_stale(amr.id, 0)  # no longer takes pickups, and moves to the front below
             self.amr_slot_reservation(amr)
             self.station_slot_reservation(amr)
-            rp(f"{amr.id} is moving to task goal {task.station.id}")
-            rp(f"Task {task.id} has {len(task.suborders)} suborders: {[suborder.suborder_id for suborder in task.suborders]}")
+            logger.info("%s is moving to task goal %s", amr.id, task.station.id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Task %s has %s suborders: %s", task.id, len(task.suborders), [suborder.suborder_id for suborder in task.suborders])
             break
         
         if not has_valid_suborder:
-            print(f"All suborders in task in {amr.id} queue are invalid")
-
-        self.amr_queues[amr.id]["tasks"].insert(0, self.amr_queues[amr.id]["tasks"].pop(assigned_task_index)) if assigned_task_index else None
+            logger.debug("All suborders in task in %s queue are invalid", amr.id)
+        if amr.status == "idle":
+            # nothing can run until a station or slot frees up, clear the way for the AMRs that can
+            self.parking_execution(amr)
+
+        if assigned_task_index:
+            self.amr_queues[amr.id].move_to_front(amr.task)
+            self.mark_expected_states_dirty(amr.id, 0)
         self.update_expected_states(amr)
 
     def task_execution(self, amr:AMR):
-        if not np.allclose([amr.position.x, amr.position.y], [amr.goal.x, amr.goal.y], atol=0.01):
+        if not self.at_goal(amr):
             self.move_to_goal(amr)
             amr.is_moving = True
             amr.is_parked = False
             return
         else:
-            rp(f"{amr.id} arrived at goal") if amr.is_moving else None
+            logger.info("%s arrived at goal", amr.id) if amr.is_moving else None
             amr.is_moving = False
 
         if not all([suborder.status=="completed" for suborder in self.tasks[amr.task_id].suborders]):
             self.suborder_execution(amr)
         else:
             self.amr_state_validation(amr)
-            self.tasks[amr.task_id].status = "completed"
-            self.amr_queues[amr.id]["tasks"].pop(0)
-            self.amr_queues[amr.id]["expected_states"].pop(0)
+            self.set_task_status(self.tasks[amr.task_id], "completed")
+            self.amr_queues[amr.id].popleft()
+            self.mark_queue_costs_stale(amr.id, 0)
             amr.status = "idle"
             amr.task_id = None
 
     def parking_execution(self, amr:AMR):
-        amr.goal = self.parkings[amr.id].position
-        if not np.allclose([amr.position.x, amr.position.y], [amr.goal.x, amr.goal.y], atol=0.01):
-            rp(f"{amr.id} is moving to parking") if not amr.is_moving else None
+        self.set_goal(amr, self.parkings[amr.id])
+        if not self.at_goal(amr):
+            logger.info("%s is moving to parking", amr.id) if not amr.is_moving else None
             self.move_to_goal(amr)
             amr.is_moving = True
         else:
-            rp(f"{amr.id} arrived parking") if amr.is_moving else None
+            logger.info("%s arrived parking", amr.id) if amr.is_moving else None
             amr.is_moving = False
             amr.is_parked = True
 
     def task_manager(self):
-        completed_tasks = []
-        for task_id, task in self.tasks.items():
-            if not isinstance(task, Task):
-                raise Exception("Unexpected task type.")
-            if task.status == "completed":
-                rp(f"Task {task.id} completed")
-                completed_tasks.append(task)
-                continue
-        for task in completed_tasks:
+        if self.completed_tasks:
+            self.release_blocked_orders() # finished tasks make room on their AMRs and stations
+        for task_id in sorted(self.completed_tasks):
+            task = self.tasks[task_id]
+            logger.info("Task %s completed", task.id)
             task.station.status = "idle"
-            self.tasks_history[task.id] = task
-            self.tasks.pop(task.id)
+            self.retire_task(task)
 
     def queue_grouper(self, amr:AMR):
         queue = self.amr_queues[amr.id]
-        if len(queue["tasks"]) == 0:
+        if len(queue) == 0:
             return
         # later can add new logic to group non-consecutive tasks, but need a lot more validation
-        for task in queue["tasks"]:
-            task_index = queue["tasks"].index(task)
-            if task.station.id != queue["tasks"][task_index-1].station.id:
+        for task_index, task in enumerate(queue):
+            if task.station.id != queue[task_index-1].station.id:
                 continue
-            task.suborders = queue["tasks"][task_index-1].suborders + task.suborders
-            queue["tasks"][task_index-1].suborders = []
+            task.suborders = queue[task_index-1].suborders + task.suborders
+            queue[task_index-1].suborders = []
+            self.mark_expected_states_dirty(amr.id, max(0, task_index-1))
         self.update_expected_states(amr)
 
     def step(self):
+        step_start = perf_counter()
+        profiler = self.profiler
+        if not self.inbox.empty():
+            with self.db_lock:
+                profiler.timed("intake", self.drain_inbox)
         if not self.paused:
             for amr in self.amrs.values():
                 if not isinstance(amr, AMR):
                     raise Exception("Unexpected amr type.")
                 queue = self.amr_queues[amr.id]
-                has_task = len(queue["tasks"]) != 0
-                has_active_task = sum(1 for task in queue["tasks"] if task.status in ["queued", "executing", "sleep"]) != 0
-                all_sleep_task = all([task.status=="sleep" for task in queue["tasks"]])
-                has_sleep_task = any([task.status=="sleep" for task in queue["tasks"]])
+                counts = self.amr_task_counts[amr.id]  # queued, executing and sleep tasks are all in the queue
+                has_task = len(queue) != 0
+                has_active_task = counts["queued"] + counts["executing"] + counts["sleep"] != 0
+                all_sleep_task = counts["sleep"] == len(queue)
+                has_sleep_task = counts["sleep"] != 0
 
                 if not has_task and amr.is_parked:
                     continue
                 if amr.status == "busy" and amr.task_id is not None:
-                    self.task_execution(amr)
+                    profiler.timed("task_execution", self.task_execution, amr)
                     continue
                 if amr.task is not None and amr.task.status == "failed":
                     amr.status = "error"
-                    rp(f"Task {amr.task.id} failed, waiting for user to cancel")
+                    logger.error("Task %s failed, waiting for user to cancel", amr.task.id)
                 if amr.status == "idle" and has_sleep_task:
-                    self.wake_task(amr)
+                    profiler.timed("wake_task", self.wake_task, amr)
                 # if amr.status == "idle" and has_task:
                 #     self.queue_grouper(amr)
                 if amr.status == "idle" and (all_sleep_task or not has_task):
-                    self.parking_execution(amr)
+                    profiler.timed("parking_execution", self.parking_execution, amr)
                     continue
                 if amr.status == "idle" and has_active_task:
-                    self.task_assignment(amr)
+                    profiler.timed("task_assignment", self.task_assignment, amr)
                     continue
 
                 # if amr.status == "error":
                 #     print(f"{amr.id} is in error state")
+            profiler.timed("move_fleet", self.move_fleet)
         
         completed_orders = []
         with self.db_lock:
-            self.task_manager()
-            for order_id, order in self.orders.items():
+            profiler.timed("task_manager", self.task_manager)
+            orders_start = perf_counter()
+            for order_id in sorted(self.changed_orders):
+                order = self.orders[order_id]
                 if not isinstance(order, Order):
                     raise Exception("Unexpected order type.")
                 if order.status != "pending":
                     continue
-                if all([suborder.status=="completed" for suborder in order.suborders.values()]):
+                outcome = self.order_outcome(order)
+                if outcome == "completed":
                     self.orders_history[order_id] = order
                     for suborder in order.suborders.values():
                         if not isinstance(suborder, SubOrder):
                             raise Exception("Unexpected suborder type.")
                         self.suborders_history[suborder.suborder_id] = suborder
                         self.suborders.pop(suborder.suborder_id)
-                    order.status = "completed"
-                    rp(f"Order {order_id} {order.status}.")
+                    self.set_order_status(order, "completed")
+                    logger.info("Order %s %s.", order_id, order.status)
                     completed_orders.append(order_id)
-                    continue
-                if any([suborder.status=="failed" for suborder in order.suborders.values()]):
-                    order.status = "failed"
-                    rp(f"Order {order_id} {order.status}.")
-                    continue
-                
-                pickup_pending = order.suborders["pickup"].status == "pending" and order.suborders["pickup"].task_id is None
-                if pickup_pending:
-                    order.assigned_amr = None
-                    order.suborders["delivery"].status = "pending"
-                    order.suborders["delivery"].task_id = None
-                    self.order_validation()
+                elif outcome == "failed":
+                    self.set_order_status(order, "failed")
+                    logger.warning("Order %s %s.", order_id, order.status)
+            self.changed_orders.clear()
+
+            pending_orders = self.pop_pending_orders(self.config.assignment_budget or math.inf)
+            for order in pending_orders:
+                order.assigned_amr = None
+                self.set_suborder_status(order.suborders["delivery"], "pending")
+                order.suborders["delivery"].task_id = None
+                self.order_validation()
+            if self.config.batch_assignment and len(pending_orders) > 1:
+                self.batch_assignment(pending_orders)
+            else:
+                for order in pending_orders:
                     self.cost_based_assignment(order)
-                    self.update_expected_states(self.amrs[order.assigned_amr])
+            for order in pending_orders:
+                if self.awaits_assignment(order) and order.order_id not in self.blocked_orders:
+                    heapq.heappush(self.pending_orders, (order.priority, order.created_at, order.order_id))
             for order_id in completed_orders:
-                self.orders.pop(order_id)
-
-if __name__ == "__main__":
-    medibot_system = MedibotSystem(render=True)
-    renderer = Renderer(medibot_system) if medibot_system.render_flag else None
-    app = create_flask_app(medibot_system)
+                order = self.orders.pop(order_id)
+                self.order_counts[order.status] -= 1
+                self.object_orders.pop(order.object_id, None)
+            profiler.record("order_assignment", perf_counter() - orders_start)
+        if self.optimizer is not None and self.optimizer.due():
+            with self.db_lock:
+                profiler.timed("optimizer", self.optimizer.tick)
+        self.clock += 1
+        if not self.snapshots.defer():
+            with self.db_lock:
+                profiler.timed("snapshot", self.snapshots.publish)
+        if self.stream.subscribers:
+            with self.db_lock:
+                profiler.timed("stream", self.stream.publish)
+        if self.checkpointer is not None and self.checkpointer.due():
+            with self.db_lock:
+                profiler.timed("checkpoint", self.checkpointer.checkpoint)
+        profiler.tick(perf_counter() - step_start)
+
+    def has_pending_work(self):
+        if self.engine.has_scheduled_orders() or not self.inbox.empty():
+            return True
+        return self.order_counts["pending"] != 0
+
+    def run(self, max_steps=None, until_drained=True, event_driven=False):
+        # Headless fast-forward: no rendering, no API, no wall-clock pacing
+        if event_driven:
+            return self.engine.run(max_ticks=max_steps, until_drained=until_drained)
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            self.engine.fire_order_arrivals()
+            if until_drained and not self.has_pending_work():
+                break
+            self.step()
+            steps += 1
+        return steps
+
+def start_api(system):
+    # Flask is only imported when the API is actually requested
+    from flask_app import create_flask_app, run_flask
+    app = create_flask_app(system)
     flask_thread = threading.Thread(target=run_flask, args=(app,), daemon=True)
     flask_thread.start()
+    return flask_thread
+
+def create_renderer(system):
+    # pygame is only imported when rendering is actually requested
+    from pygame_renderer import Renderer
+    return Renderer(system)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="STARK medibot fleet simulation")
+    parser.add_argument("--headless", action="store_true", help="run without renderer, API or wall-clock pacing")
+    parser.add_argument("--steps", type=int, default=None, help="number of steps to run in headless mode")
+    parser.add_argument("--fixed-tick", action="store_true", help="step every tick in headless mode instead of jumping between events")
+    parser.add_argument("--no-render", action="store_true", help="disable the pygame renderer")
+    parser.add_argument("--no-api", action="store_true", help="disable the Flask API")
+    parser.add_argument("--log-level", default=None, help=f"event log level (default {LOG_LEVEL}, console shows WARNING and above in headless mode)")
+    parser.add_argument("--checkpoint", default=None, metavar="PATH", help=f"checkpoint to PATH every {CHECKPOINT_INTERVAL} ticks and log submitted orders to PATH.wal.*")
+    parser.add_argument("--restore", action="store_true", help="resume from the --checkpoint file and its WAL if it exists")
+    args = parser.parse_args(argv)
+    if args.log_level:
+        set_level(args.log_level.upper())
+    enable_console("WARNING" if args.headless and not args.log_level else None)
+    if args.restore and not args.checkpoint:
+        parser.error("--restore requires --checkpoint PATH")
+
+    if args.headless:
+        medibot_system = MedibotSystem(render=False)
+        if args.checkpoint:
+            medibot_system.enable_checkpoints(args.checkpoint, restore=args.restore)
+        steps = medibot_system.run(max_steps=args.steps, until_drained=args.steps is None, event_driven=not args.fixed_tick)
+        if medibot_system.checkpointer is not None:
+            medibot_system.checkpointer.wait()
+        print(f"Ran {steps} steps, {len(medibot_system.orders_history)} orders completed")
+        return medibot_system
+
+    medibot_system = MedibotSystem(render=not args.no_render)
+    if args.checkpoint:
+        medibot_system.enable_checkpoints(args.checkpoint, restore=args.restore)
+    renderer = create_renderer(medibot_system) if medibot_system.render_flag else None
+    if not args.no_api:
+        start_api(medibot_system)
     while True:
         start = time.time()
         medibot_system.step()
         renderer.render() if medibot_system.render_flag else None
         renderer.handle_events() if medibot_system.render_flag else None
-        time.sleep(max(0, 0.01 - (time.time() - start)))  # Maintain 10Hz
-        # rp(f"Time taken per step: {time.time() - start:.5f} seconds")
+        time.sleep(max(0, TICK_PERIOD - (time.time() - start)))  # Maintain TICK_PERIOD pacing
+        # logger.debug(f"Time taken per step: {time.time() - start:.5f} seconds")
+
+if __name__ == "__main__":
+    main()
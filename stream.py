@@ -0,0 +1,111 @@
+import collections
+import json
+import threading
+from configs import *
+
+def diff_section(old, new, removed=None):
+    # changed or added entries of new, entries missing from new map to removed(key)
+    changes = {key: value for key, value in new.items() if old.get(key) != value}
+    for key in old:
+        if key not in new:
+            changes[key] = removed(key) if removed else None
+    return changes
+
+class StateStream:
+    """Per-step diffs of orders, AMR queues, AMR positions/slots and station slots for /medibot/stream.
+
+    Events are (seq, type, json) with type "diff" or "full"; a "full" event replaces the client state.
+    Diffs are only computed while someone is subscribed; after a gap the next event is a "full" one,
+    and a client resuming from a sequence number that is no longer buffered, or that this stream never
+    reached (e.g. from before a restart), gets a "full" event first.
+    """
+    def __init__(self, system, capacity=STREAM_BUFFER):
+        self.system = system
+        self.condition = threading.Condition()
+        self.events = collections.deque(maxlen=capacity)
+        self.seq = 0
+        self.state = None   # last published state, None when there is no baseline to diff against
+        self.subscribers = 0
+
+    def capture(self):
+        # Caller holds db_lock
+        system = self.system
+        return {
+            "orders": {order_id: order.status for order_id, order in system.orders.items()},
+            "queues": {amr_id: [[str(task.id), task.status, task.station.id, [str(suborder.suborder_id) for suborder in task.suborders]]
+                                for task in queue] for amr_id, queue in system.amr_queues.items()},
+            "amrs": {amr_id: [round(amr.position.x, 2), round(amr.position.y, 2), amr.status, list(amr.slots.objects)]
+                     for amr_id, amr in system.amrs.items()},
+            "stations": {station_id: list(station.slots.objects) for station_id, station in system.stations.items()},
+        }
+
+    def finished_order_status(self, order_id):
+        order = self.system.orders_history.get(order_id)
+        return order.status if order is not None else None
+
+    def publish(self):
+        # Caller holds db_lock, called at the end of step() while there are subscribers
+        state = self.capture()
+        clock = self.system.clock
+        with self.condition:
+            if self.state is None:
+                event_type, payload = "full", state
+            else:
+                event_type = "diff"
+                payload = {
+                    "orders": diff_section(self.state["orders"], state["orders"], self.finished_order_status),
+                    "queues": diff_section(self.state["queues"], state["queues"]),
+                    "amrs": diff_section(self.state["amrs"], state["amrs"]),
+                    "stations": diff_section(self.state["stations"], state["stations"]),
+                }
+                payload = {section: changes for section, changes in payload.items() if changes}
+            self.state = state
+            if event_type == "diff" and not payload:
+                return
+            self.seq += 1
+            self.events.append((self.seq, event_type, json.dumps({"seq": self.seq, "clock": clock, **payload})))
+            self.condition.notify_all()
+
+    def invalidate(self):
+        # the next event is a full one, e.g. after the system state was replaced
+        with self.condition:
+            self.state = None
+
+    def full_event(self):
+        # Caller holds self.condition
+        return (self.seq, "full", json.dumps({"seq": self.seq, "clock": self.system.clock, **self.state}))
+
+    def follow(self, since=None, keepalive=STREAM_KEEPALIVE):
+        """Yield events after sequence number since, (None, None, None) as a keepalive when idle."""
+        with self.condition:
+            self.subscribers += 1
+            backlog = []
+            # a cursor past self.seq is from before a restart or reset, it is unknown like one that left the buffer
+            if since is not None and since <= self.seq and (since == self.seq or (self.events and self.events[0][0] <= since + 1)):
+                cursor = since
+            elif self.state is not None:
+                backlog.append(self.full_event())
+                cursor = self.seq
+            else:
+                cursor = self.seq # the first publish after subscribing is a full event
+        try:
+            yield from backlog
+            while True:
+                with self.condition:
+                    if self.seq == cursor:
+                        self.condition.wait(keepalive)
+                    if self.events and self.events[0][0] > cursor + 1:
+                        pending = [self.full_event()] # fell behind the buffer
+                    else:
+                        pending = [event for event in self.events if event[0] > cursor]
+                if not pending:
+                    yield (None, None, None)
+                    continue
+                for event in pending:
+                    yield event
+                cursor = pending[-1][0]
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                if self.subscribers == 0:
+                    self.state = None # no diffs are computed until the next subscriber
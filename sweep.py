@@ -0,0 +1,141 @@
+import argparse
+import csv
+import itertools
+import os
+import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from configs import *
+from eventlog import set_level
+
+# Parameter sweeps over seeded scenarios, one MedibotSystem per scenario spread over a process pool:
+#   python sweep.py --fleet-size 1 2 3 --distance-cost 1 2 --seeds 8 --orders 40
+
+SWEEP_PARAMETERS = ["fleet_size", "total_stations", "amr_slot_capacity", "station_slot_capacity", "objects",
+                    "distance_cost", "transfer_cost", "step_distance", "suborder_duration", "batch_assignment", "assignment_budget",
+                    "cheapest_insertion", "optimizer_interval", "station_wait_timeout", "roadmap"]
+METRICS = ["completed", "failed", "pending", "ticks", "throughput", "latency_mean", "latency_p95", "travel", "travel_per_order"]
+
+def scenario_grid(grid:dict, seeds, orders=20, arrival_interval=10, max_ticks=20000):
+    """Every combination of the grid values (config name -> list of values), once per seed."""
+    names = list(grid)
+    scenarios = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for seed in seeds:
+            scenarios.append({**dict(zip(names, values)), "seed": seed, "orders": orders,
+                              "arrival_interval": arrival_interval, "max_ticks": max_ticks})
+    return scenarios
+
+def schedule_orders(system, rng, count, arrival_interval):
+    # each order moves a distinct object away from where it spawned, arriving every arrival_interval ticks
+    object_ids = sorted(system.objects)
+    rng.shuffle(object_ids)
+    if count > len(object_ids):
+        raise Exception(f"{count} orders need {count} objects, the system has {len(object_ids)}")
+    for i, object_id in enumerate(object_ids[:count]):
+        source = system.objects[object_id][0]
+        destination = rng.choice([station_id for station_id in system.stations if station_id != source])
+        system.engine.schedule_order(i * arrival_interval, object_id, source, destination)
+
+def run_scenario(scenario:dict):
+    """Run one seeded scenario headless and event-driven, returns the scenario with its metrics."""
+    from stark import MedibotSystem
+    # the optimizer searches inline so every seed reproduces
+    config = SystemConfig(seed=scenario["seed"], optimizer_thread=False, **{name: scenario[name] for name in SWEEP_PARAMETERS if name in scenario})
+    system = MedibotSystem(config=config)
+    schedule_orders(system, random.Random(scenario["seed"] + 1), scenario["orders"], scenario["arrival_interval"])
+    system.run(max_steps=scenario["max_ticks"], until_drained=True, event_driven=True)
+
+    # finished orders are archived only once completed, failed ones stay live with their status
+    latencies = []
+    counts = {"completed": 0, "failed": 0, **system.order_counts}
+    after = 0
+    while True:
+        records = system.orders_history.query(after=after, limit=1000)
+        for _, clock, view in records:
+            counts[view["status"]] = counts.get(view["status"], 0) + 1
+            if view["status"] == "completed":
+                latencies.append(clock - view["created_at"])
+        if len(records) < 1000:
+            break
+        after = records[-1][0]
+    travel = float(system.amr_travelled.sum())
+    return {
+        **scenario,
+        "completed": counts["completed"],
+        "failed": counts["failed"],
+        "pending": counts.get("pending", 0),
+        "ticks": system.clock,
+        "throughput": counts["completed"] * 1000 / system.clock if system.clock else 0.0,  # per 1000 ticks
+        "latency_mean": float(np.mean(latencies)) if latencies else None,
+        "latency_p95": float(np.percentile(latencies, 95)) if latencies else None,
+        "travel": travel,
+        "travel_per_order": travel / counts["completed"] if counts["completed"] else None,
+    }
+
+def quiet_worker():
+    # per-order INFO events are only kept in the worker's ring buffer, skip formatting them
+    set_level("WARNING")
+
+def sweep(scenarios:list, workers=None):
+    """Run the scenarios on a process pool (all cores by default), results in scenario order."""
+    if workers == 1:
+        quiet_worker()
+        return [run_scenario(scenario) for scenario in scenarios]
+    with ProcessPoolExecutor(max_workers=workers, initializer=quiet_worker) as executor:
+        return list(executor.map(run_scenario, scenarios, chunksize=1))
+
+def aggregate(results:list, keys:list):
+    """Mean of every metric over the seeds of each parameter combination."""
+    groups = {}
+    for result in results:
+        groups.setdefault(tuple(result[key] for key in keys), []).append(result)
+    rows = []
+    for values, group in groups.items():
+        row = {**dict(zip(keys, values)), "runs": len(group)}
+        for metric in METRICS:
+            samples = [result[metric] for result in group if result[metric] is not None]
+            row[metric] = float(np.mean(samples)) if samples else None
+        rows.append(row)
+    return rows
+
+def format_table(rows:list, columns:list):
+    def cell(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:.2f}"
+        return str(value)
+    table = [columns] + [[cell(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return "\n".join("  ".join(value.rjust(width) for value, width in zip(line, widths)) for line in table)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep MedibotSystem parameters over seeded scenarios")
+    flag = lambda value: value.lower() in ["1", "true", "yes"]
+    for name in SWEEP_PARAMETERS:
+        kind = {"batch_assignment": flag, "cheapest_insertion": flag, "roadmap": lambda value: None if value == "none" else value,
+                "distance_cost": float, "transfer_cost": float}.get(name, int)
+        parser.add_argument(f"--{name.replace('_', '-')}", type=kind, nargs="+", default=None, help=f"values to sweep (default {getattr(SystemConfig(), name)})")
+    parser.add_argument("--seeds", type=int, default=4, help="seeds per parameter combination")
+    parser.add_argument("--orders", type=int, default=20, help="orders per scenario, each moves a distinct object")
+    parser.add_argument("--arrival-interval", type=int, default=10, help="ticks between order arrivals")
+    parser.add_argument("--max-ticks", type=int, default=20000, help="ticks before a scenario is cut off")
+    parser.add_argument("--workers", type=int, default=None, help=f"worker processes (default {os.cpu_count()})")
+    parser.add_argument("--csv", default=None, metavar="PATH", help="also write the per-seed results to PATH")
+    args = parser.parse_args(argv)
+
+    grid = {name: getattr(args, name) for name in SWEEP_PARAMETERS if getattr(args, name) is not None}
+    scenarios = scenario_grid(grid, range(args.seeds), args.orders, args.arrival_interval, args.max_ticks)
+    results = sweep(scenarios, workers=args.workers)
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    keys = list(grid)
+    print(format_table(aggregate(results, keys), keys + ["runs"] + METRICS))
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import random
+from configs import SystemConfig
+from eventlog import set_level
+from optimizer import feasible
+from stark import MedibotSystem
+from sweep import schedule_orders
+
+set_level("WARNING")
+
+def test_feasible_keeps_the_spare_slot():
+    # AMR of 4 slots holding 3 objects, one of them delivered at station 2
+    deliver_first = [(2, ((3, False, 10),), None), (0, ((1, True, 11),), None), (1, ((2, False, 11),), None)]
+    pickup_first = [deliver_first[1], deliver_first[2], deliver_first[0]]
+    assert feasible(deliver_first, 3, 3, 8)
+    assert not feasible(pickup_first, 3, 3, 8)
+
+def over_limit(system, amr_id):
+    # the queued tail needs the spare slot somewhere, sleeping deliveries counted as on board
+    tasks = system.amr_queues[amr_id]
+    loads = system.queue_tables(amr_id).loads[system.optimizer.tail_start(tasks):]
+    return bool(len(loads)) and int(loads.max()) > system.config.amr_slot_capacity - 1
+
+def run(seed, fleet_size, cheapest_insertion, optimizer_interval):
+    config = SystemConfig(seed=seed, fleet_size=fleet_size, optimizer_interval=optimizer_interval, optimizer_thread=False,
+                          cheapest_insertion=cheapest_insertion)
+    system = MedibotSystem(config=config)
+    optimizer = system.optimizer
+    if optimizer is not None:
+        apply = optimizer.apply
+        def checked_apply(result):
+            before = {amr_id: over_limit(system, amr_id) for amr_id in result["queues"]}
+            applied = apply(result)
+            for amr_id in result["queues"] if applied else []:
+                assert before[amr_id] or not over_limit(system, amr_id), f"{amr_id} over the spare-slot limit at tick {system.clock}"
+            return applied
+        optimizer.apply = checked_apply
+    schedule_orders(system, random.Random(seed + 1), 18, 10)
+    system.run(max_steps=8000, until_drained=True, event_driven=True)
+    assert all(amr.status != "error" for amr in system.amrs.values())
+    assert system.order_counts.get("failed", 0) == 0
+    return len(system.orders_history)
+
+def test_optimizer_seeded_runs():
+    # seed 5 raised "Not enough effective amr slots" at tick 777, seed 4 rewrote a queue into the spare slot at tick 100
+    for seed, fleet_size, cheapest_insertion in [(5, 2, True), (5, 2, False), (4, 2, False)]:
+        assert run(seed, fleet_size, cheapest_insertion, 50) == run(seed, fleet_size, cheapest_insertion, 0)